@@ -0,0 +1,91 @@
+# Event-driven audio capture: call frames are pushed by pjsua into a ring buffer
+
+import threading
+
+import numpy as np
+import pjsua2 as pj
+
+
+def pcm_port_format(sample_rate: int) -> pj.MediaFormatAudio:
+    """Mono 16 bit PCM format with 20 ms frames, for custom conference ports."""
+    fmt = pj.MediaFormatAudio()
+    fmt.type = pj.PJMEDIA_TYPE_AUDIO
+    fmt.init(pj.PJMEDIA_FORMAT_PCM, sample_rate, 1, 20000, 16)
+    return fmt
+
+
+class PCMRingBuffer:
+    def __init__(self, capacity: int):
+        """Fixed size ring buffer of 16 bit PCM samples shared by a producer and a consumer.
+
+        Args:
+            capacity (int): number of samples the buffer holds. When the consumer
+                falls behind, the oldest unread samples are overwritten.
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.write_position = 0
+        self.read_position = 0
+        self.dropped_samples = 0
+        self.condition = threading.Condition()
+
+    def available(self) -> int:
+        return self.write_position - self.read_position
+
+    def write(self, samples: np.ndarray) -> None:
+        """Append samples and wake up the consumer."""
+        samples = samples[-self.capacity :]
+        with self.condition:
+            start = self.write_position % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self.buffer[start : start + first] = samples[:first]
+            self.buffer[: len(samples) - first] = samples[first:]
+            self.write_position += len(samples)
+            overflow = self.available() - self.capacity
+            if overflow > 0:
+                self.dropped_samples += overflow
+                self.read_position += overflow
+            self.condition.notify_all()
+
+    def read(self, timeout: float) -> bytes:
+        """Return all unread samples as PCM bytes, waiting up to `timeout` seconds for new ones."""
+        with self.condition:
+            if not self.available():
+                self.condition.wait(timeout)
+            size = self.available()
+            start = self.read_position % self.capacity
+            end = start + size
+            self.read_position += size
+            if end <= self.capacity:
+                return self.buffer[start:end].tobytes()
+            return (
+                self.buffer[start:].tobytes()
+                + self.buffer[: end - self.capacity].tobytes()
+            )
+
+
+class AudioFramePort(pj.AudioMediaPort):
+    def __init__(self, sample_rate: int, buffer_duration: float):
+        """Conference port receiving the remote party audio frame by frame.
+
+        Args:
+            sample_rate (int): sampling rate of the port, pjsua resamples to it.
+            buffer_duration (float): ring buffer size in seconds.
+        """
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.ring_buffer = PCMRingBuffer(int(sample_rate * buffer_duration))
+
+    def create(self, name: str) -> None:
+        """Register the port in the conference bridge as a mono 16 bit PCM port."""
+        self.createPort(name, pcm_port_format(self.sample_rate))
+
+    def onFrameReceived(self, frame):
+        """Invoked by the media thread for every frame sent to this port."""
+        if frame.type != pj.PJMEDIA_FRAME_TYPE_AUDIO or frame.size == 0:
+            return
+        samples = np.frombuffer(bytes(frame.buf), dtype=np.int16)
+        self.ring_buffer.write(samples)
+
+    def read(self, timeout: float) -> bytes:
+        return self.ring_buffer.read(timeout)
@@ -4,7 +4,22 @@ import numpy as np
 import torch
 import torchaudio
 
-from utils import get_logger, retrieve_wav
+from config import Algorithm
+from utils import (
+    LRUCache,
+    get_logger,
+    recording_object_names,
+    retrieve_features,
+    retrieve_wav,
+    store_features,
+)
+
+# latest call fingerprint per dialed number: dialed_number -> (call_id, fingerprint)
+_fingerprint_cache = LRUCache(
+    Algorithm.fingerprint_cache_size,
+    max_bytes=Algorithm.fingerprint_cache_bytes,
+    sizeof=lambda entry: entry[1].numel() * entry[1].element_size(),
+)
 
 
 class AudioMatching:
@@ -16,6 +31,7 @@ class AudioMatching:
         hop_length: int = 256,
         key_duration: float = 1.0,
         std_threshold: float = 3.5,
+        distance: str = "l1",
     ):
         """Audio matching class to match key audio segment in query audio segment.
 
@@ -27,6 +43,8 @@ class AudioMatching:
             key_duration (float, optional): key duration in seconds. Defaults to 1.0.
             std_threshold (float, optional): standard deviation threshold. Defaults to 3.5. Use up to 4 to be very
                 strict, or decrease to 2.5 to be more lenient.
+            distance (str, optional): sliding window distance, one of "l1" (mean absolute difference), "l2" (mean
+                squared difference) or "ncc" (1 - normalized cross correlation, computed with FFT). Defaults to "l1".
         """
         self.sample_rate = sample_rate
         self.n_mels = n_mels
@@ -34,6 +52,7 @@ class AudioMatching:
         self.hop_length = hop_length
         self.key_duration = key_duration
         self.std_threshold = std_threshold
+        self.distance = distance
         self.logger = get_logger()
         self.transform = torchaudio.transforms.MelSpectrogram(
             sample_rate=sample_rate,
@@ -41,6 +60,16 @@ class AudioMatching:
             hop_length=hop_length,
             n_mels=n_mels,
         )
+        # number of frames of the shortest comparable query (key_duration seconds)
+        self.min_query_frames = int(key_duration * sample_rate) // hop_length + 1
+
+    def compute_features(self, segment: torch.Tensor) -> torch.Tensor:
+        """Compute log mel spectrogram of shape (1, n_mels, T) for a segment of shape (1, T)."""
+        return torch.log10(self.transform(segment) + 1)
+
+    def compute_fingerprint(self, segment: torch.Tensor) -> torch.Tensor:
+        """Fingerprint of a recording of shape (1, T): its log mel features as float16, half their size."""
+        return self.compute_features(segment).half()
 
     def compute_diff(
         self,
@@ -55,11 +84,28 @@ class AudioMatching:
 
             Note: Tk should be smaller that Tq (Tk < Tq)
 
+        Returns:
+            bool: False if the key and query are not comparable, otherwise the feature diff np.array
+        """
+        mel_query = self.compute_features(query_segment)
+        return self.compute_feature_diff(key_segment, mel_query)
+
+    def compute_feature_diff(
+        self,
+        key_segment: torch.Tensor,
+        mel_query: torch.Tensor,
+    ) -> bool:
+        """Compute cross correlation between key segment and precomputed query features.
+
+        Args:
+            key_segment (torch.Tensor): key segment of shape (1, Tk)
+            mel_query (torch.Tensor): query log mel spectrogram of shape (1, n_mels, Fq), or its fingerprint
+
         Returns:
             bool: False if the key and query are not comparable, otherwise the feature diff np.array
         """
         # check query segment length
-        if query_segment.shape[1] < int(self.key_duration * self.sample_rate):
+        if mel_query.shape[2] < self.min_query_frames:
             return False
         # select center piece of key segment
         if key_segment.shape[1] > int(self.key_duration * self.sample_rate):
@@ -70,15 +116,70 @@ class AudioMatching:
         else:
             return False
         # compute mel spectrogram
-        mel_key = torch.log10(self.transform(key_segment) + 1)
-        mel_query = torch.log10(self.transform(query_segment) + 1)
-        # Perform the difference
+        mel_key = self.compute_features(key_segment)
+        mel_query = mel_query.float()
+        # Perform the difference for all offsets at once
+        match self.distance:
+            case "l1":
+                diff = self.sliding_lp_distance(mel_key, mel_query, p=1)
+            case "l2":
+                diff = self.sliding_lp_distance(mel_key, mel_query, p=2)
+            case "ncc":
+                diff = self.sliding_ncc_distance(mel_key, mel_query)
+            case _:
+                raise ValueError(f"Unknown distance: {self.distance}")
+        return diff.numpy().astype(np.float32)
+
+    @staticmethod
+    def sliding_lp_distance(
+        mel_key: torch.Tensor,
+        mel_query: torch.Tensor,
+        p: int,
+    ) -> torch.Tensor:
+        """Mean absolute (p=1) or squared (p=2) difference of key against every query window.
+
+        Args:
+            mel_key (torch.Tensor): key features of shape (C, F, Tk)
+            mel_query (torch.Tensor): query features of shape (C, F, Tq)
+
+        Returns:
+            torch.Tensor: distance per offset, of shape (Tq - Tk,)
+        """
+        tk = mel_key.shape[2]
+        tq = mel_query.shape[2]
+        # (C, F, Tq - Tk, Tk) strided view over the query, no copy
+        windows = mel_query.unfold(2, tk, 1)[:, :, : tq - tk]
+        diff = (windows - mel_key.unsqueeze(2)).abs()
+        if p == 2:
+            diff = diff.square()
+        return diff.mean(dim=(0, 1, 3))
+
+    @staticmethod
+    def sliding_ncc_distance(
+        mel_key: torch.Tensor,
+        mel_query: torch.Tensor,
+    ) -> torch.Tensor:
+        """One minus normalized cross correlation of key against every query window.
+
+        Args:
+            mel_key (torch.Tensor): key features of shape (C, F, Tk)
+            mel_query (torch.Tensor): query features of shape (C, F, Tq)
+
+        Returns:
+            torch.Tensor: distance per offset, of shape (Tq - Tk,)
+        """
         tk = mel_key.shape[2]
         tq = mel_query.shape[2]
-        diff_list = [
-            (mel_query[:, :, t : t + tk] - mel_key).abs().mean() for t in range(tq - tk)
-        ]
-        return np.array(diff_list, dtype=np.float32)
+        # correlation for all offsets with FFT; offsets below Tq - Tk never wrap around
+        spectrum = torch.fft.rfft(mel_query, n=tq) * torch.fft.rfft(mel_key, n=tq).conj()
+        correlation = torch.fft.irfft(spectrum, n=tq).sum(dim=(0, 1))[: tq - tk]
+        # energy of every query window with a cumulative sum
+        energy = mel_query.square().sum(dim=(0, 1)).cumsum(0)
+        energy = torch.cat([energy.new_zeros(1), energy])
+        window_energy = energy[tk:tq] - energy[: tq - tk]
+        key_energy = mel_key.square().sum()
+        norm = (window_energy * key_energy).clamp_min(1e-12).sqrt()
+        return 1 - correlation / norm
 
     def decide_dissimilarity(self, diff: torch.Tensor) -> bool:
         """Decide if key segment is found in query segment."""
@@ -89,25 +190,77 @@ class AudioMatching:
             return True
         return False
 
-    def match_segments(self, key_np_array: np.ndarray, query_wav_obj: str) -> bool:
+    def store_fingerprint(self, wav_path: str, call_id: str, dialed_number: str) -> None:
+        """Compute the fingerprint of a finished call, cache it by dialed number and upload it.
+
+        Args:
+            wav_path (str): path to the local call recording
+            call_id (str): call id, used as object name in object storage
+            dialed_number (str): dialed number, used as cache key
+        """
+        try:
+            wav_array, _ = torchaudio.load(wav_path)
+        except Exception:
+            self.logger.exception("Can not load call recording for fingerprinting.")
+            return
+        fingerprint = self.cache_fingerprint(wav_array[:1], call_id, dialed_number)
+        store_features(call_id, fingerprint.numpy())
+
+    def cache_fingerprint(
+        self, segment: torch.Tensor, call_id: str, dialed_number: str
+    ) -> torch.Tensor:
+        """Compute the fingerprint of a call recording of shape (1, T) and cache it by dialed number."""
+        fingerprint = self.compute_fingerprint(segment)
+        _fingerprint_cache.put(dialed_number, (call_id, fingerprint))
+        return fingerprint
+
+    def get_fingerprint(self, call_id: str, dialed_number: str) -> torch.Tensor | None:
+        """Get the fingerprint of a previous call from cache, object storage or, for old calls, its recording."""
+        cached = _fingerprint_cache.get(dialed_number)
+        if cached is not None and cached[0] == call_id:
+            return cached[1]
+        features = retrieve_features(call_id)
+        if features is not None:
+            features = torch.from_numpy(features).half()
+        else:
+            # calls recorded before features were stored
+            for object_name in recording_object_names(call_id):
+                query_segment = retrieve_wav(object_name)
+                if query_segment.shape[0] != 0:
+                    break
+            else:
+                return None
+            features = self.compute_fingerprint(query_segment[:1])
+        _fingerprint_cache.put(dialed_number, (call_id, features))
+        return features
+
+    def match_segments(
+        self,
+        key_np_array: np.ndarray,
+        query_call_id: str,
+        dialed_number: str,
+    ) -> bool:
         """Match key segment in query segment.
 
         Args:
             key_np_array (np.ndarray): key wav file numpy array ()
-            query_wav_obj (str): path to query wav file located in object storage
+            query_call_id (str): call id of the previous call to the dialed number
+            dialed_number (str): dialed number of both calls
 
         Returns:
             bool: True if key segment is found in query segment.
         """
+        if not query_call_id:
+            return False
         # convert key_np_array to torch tencor
         key_segment = torch.from_numpy(key_np_array).unsqueeze(0)
-        # retrieve segments
-        query_segment = retrieve_wav(query_wav_obj)
-        if query_segment.shape[0] == 0:
+        # retrieve query fingerprint
+        mel_query = self.get_fingerprint(query_call_id, dialed_number)
+        if mel_query is None:
             self.logger.warning("query segment is empty")
             return False
         # compute cross correlation
-        cross_correlation = self.compute_diff(key_segment, query_segment)
+        cross_correlation = self.compute_feature_diff(key_segment, mel_query)
         if cross_correlation is False:
             return False
         return self.decide_dissimilarity(cross_correlation)
@@ -26,6 +26,15 @@ class AIEndpoints:
     asr_decoder_endpoint: str = f"{base_prediction_url}asr_decoder"
     gender_detection: str = f"{base_prediction_url}gender_detection"
     timeout: float = 1
+    # connection pools per session, one per host (AM, ASR, gender may be served apart)
+    pool_connections: int = 4
+    pool_maxsize: int = 16
+    max_retries: int = 1
+    am_streaming: bool = False
+    # ask the AM for binary posteriors (see utils.encode_am_posteriors) instead of base64 text
+    am_binary: bool = True
+    # AM input: "wav" files or "pcm" (raw 16 bit samples, see utils.encode_pcm_segment)
+    am_input_format: str = "wav"
 
 
 @dataclass
@@ -37,6 +46,11 @@ class Database:
     table_name: str = os.getenv("DB_TABLE")
     url: str = f"postgresql+psycopg2://{user}:{password}@{host}/{db_name}"
     timeout: int = 500  # database timeout in milliseconds
+    pool_size: int = 10
+    max_overflow: int = 10
+    pool_recycle: int = 1800
+    history_cache_size: int = 100000
+    history_cache_ttl: float = 300
 
 
 @dataclass
@@ -51,6 +65,40 @@ class ObjectStorage:
     minio_secret_key: str = os.getenv("MINIO_SECRET_KEY")
     minio_wav_bucket_name: str = "wavs"
     minio_metadata_bucket_name: str = "metadata"
+    minio_features_bucket_name: str = "features"
+    # recordings are uploaded as "wav", "flac" or "opus"
+    recording_format: str = "wav"
+    # keep only the SAD speech regions, widened by speech_margin seconds
+    speech_only: bool = False
+    speech_margin: float = 0.3
+
+
+@dataclass
+class Persistence:
+    batch_size: int = 50
+    flush_interval: float = 1.0
+    upload_workers: int = 4
+    retry_interval: float = 60
+    spool_dir: str = str(file_path / "../spool")
+
+
+@dataclass
+class Tracing:
+    # serve stage histograms at http://<agent>:<metrics_port>/metrics, 0 disables it
+    metrics_port: int = 0
+    # rewrite stage histograms to this file every metrics_interval seconds, "" disables it
+    metrics_file: str = str(file_path / "../stage_metrics.prom")
+    metrics_interval: float = 10.0
+
+
+@dataclass
+class Profiling:
+    # seconds between two resource samples
+    interval: float = 1.0
+    # cProfile every call handler, dumped to <profile dir>/agent.pstats
+    cprofile: bool = False
+    # record a flame graph with py-spy, when it is installed
+    py_spy: bool = False
 
 
 @dataclass
@@ -59,11 +107,18 @@ class UserAgent:
     max_media_consent: float = 1.0
     log_level: int = logging.DEBUG
     renew_time: float = 60
+    max_concurrent_calls: int = 4
+    # calls waiting for a free worker; 0 rejects (486 Busy Here) when all workers are busy
+    max_queued_calls: int = 4
+    io_workers: int = 16
 
 
 @dataclass
 class Algorithm:
+    sample_rate: int = 16000
+    sad_batch_window: float = 0.005
     chunk_interval: float = 0.1
+    capture_buffer_duration: float = 5.0
     max_call_duration: float = 15.0
     zero_padding: int = 4000
     max_tail_sil: float = 1.0
@@ -74,12 +129,32 @@ class Algorithm:
     redis_host: str = os.getenv("REDIS_HOST")
     redis_port: str = os.getenv("REDIS_PORT")
     expiration_time_second: int = 6000
+    redis_audit: bool = True
+    redis_am_dtype: str = "uint8"
     receiving_active_segment_sleep: float = 0.1
     receiving_silent_segment_sleep: float = 1.0
     kws_threshold: float = 0.15
+    stream_chunk_duration: float = 1.0
+    stream_context_duration: float = 0.5
+    # previous posteriors searched again with each chunk, to be longer than any keyword
+    stream_search_overlap: float = 1.5
+    am_asr_kws_workers: int = 8
+    fingerprint_cache_size: int = 4096
+    fingerprint_cache_bytes: int = 256 * 2**20
     background_noise_dir: str = str(file_path / "../playbacks/background")
 
 
+@dataclass
+class Decision:
+    # evidence weights; AMD is declared once their sum reaches am_threshold
+    kws_weight: float = 1.0
+    asr_keyword_weight: float = 1.0
+    asr_repeat_weight: float = 1.0
+    audio_match_weight: float = 1.0
+    am_threshold: float = 1.0
+    gender_playback_on_early_verdict: bool = False
+
+
 @dataclass
 class CallbackAPIs:
     address: str = os.getenv("CALLBACK_API_ADDRESS")
@@ -143,6 +218,10 @@ class KWSConfig:
     max_gap: int = 25
     clip_char_prob: float = 0.01
     am_keywords_url: str = "https://127.0.0.1:443/api/get_keywords"
+    am_keywords_refresh_interval: float = 60
+    am_keywords_timeout: float = 2.0
+    # match ASR keywords on word boundaries only
+    asr_word_boundary: bool = True
     am_keywords: ClassVar[list[str]] = [
         "LEAVE YOUR NAME",
         "LEAVE A NAME",
@@ -15,14 +15,19 @@ class Call(pj.Call):
 
 
 class Account(pj.Account):
-    def __init__(self):
+    def __init__(self, dispatcher):
         super().__init__()
-        self._call = None
+        self._dispatcher = dispatcher
 
     def onIncomingCall(self, prm):
+        """Ring the call and hand it to a worker, or reject it when saturated."""
         call = Call(self, call_id=prm.callId)
         call_prm = pj.CallOpParam(True)
-        call_prm.statusCode = pj.PJSIP_SC_OK
-        call.answer(call_prm)
-        self._call = call
+        if self._dispatcher.acquire_slot():
+            call_prm.statusCode = pj.PJSIP_SC_RINGING
+            call.answer(call_prm)
+            self._dispatcher.dispatch(call)
+        else:
+            call_prm.statusCode = pj.PJSIP_SC_BUSY_HERE
+            call.answer(call_prm)
         return super().onIncomingCall(prm)
@@ -4,7 +4,13 @@ from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
 from config import Database
 
 url = f"postgresql+psycopg2://{Database.user}:{Database.password}@{Database.host}/{Database.db_name}"
-engine = create_engine(url)
+engine = create_engine(
+    url,
+    pool_size=Database.pool_size,
+    max_overflow=Database.max_overflow,
+    pool_recycle=Database.pool_recycle,
+    pool_pre_ping=True,
+)
 db_session = scoped_session(
     sessionmaker(
         autocommit=False,
@@ -0,0 +1,61 @@
+# Incremental decision engine: score AMD evidence as it arrives
+
+import json
+import time
+
+from config import Decision
+
+
+class DecisionEngine:
+    # short names used in the metadata "reason" of early verdicts
+    reasons = {
+        "kws": "kws",
+        "streaming_kws": "streaming kws",
+        "asr_keyword": "asr",
+        "asr_repeat": "asr repeat",
+        "audio_match": "audio match",
+    }
+
+    def __init__(self):
+        """Accumulate weighted AMD evidence and tell when the verdict is conclusive.
+
+        Each signal counts once, with its weight from `config.Decision`, and the
+        verdict is AMD as soon as the score reaches `Decision.am_threshold`.
+        """
+        self.weights = {
+            "kws": Decision.kws_weight,
+            "streaming_kws": Decision.kws_weight,
+            "asr_keyword": Decision.asr_keyword_weight,
+            "asr_repeat": Decision.asr_repeat_weight,
+            "audio_match": Decision.audio_match_weight,
+        }
+        self.threshold = Decision.am_threshold
+        self.t0 = time.time()
+        # signal -> seconds since the engine was created
+        self.evidence = {}
+
+    def add(self, signal: str, present: bool) -> bool:
+        """Record a signal if present, return whether the verdict is now conclusive."""
+        if present and signal not in self.evidence:
+            self.evidence[signal] = time.time() - self.t0
+        return self.is_conclusive()
+
+    def add_segment_result(self, asr_result: str, kws_result: str, keyword_matcher) -> bool:
+        """Record the KWS and ASR keyword signals of one segment result."""
+        self.add("kws", len(json.loads(kws_result)) > 0)
+        self.add("asr_keyword", keyword_matcher.search(asr_result))
+        return self.is_conclusive()
+
+    def score(self) -> float:
+        return sum(self.weights[signal] for signal in self.evidence)
+
+    def is_conclusive(self) -> bool:
+        return self.score() >= self.threshold
+
+    def reason(self) -> str:
+        """Name of the first signal, the one that started the verdict."""
+        first_signal = min(self.evidence, key=self.evidence.get)
+        return self.reasons[first_signal]
+
+    def verdict(self) -> str:
+        return "AMD" if self.is_conclusive() else "non-AMD"
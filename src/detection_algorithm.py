@@ -1,193 +1,335 @@
 # answering machine detection algorithm
 
-import json
 import time
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 
-import numpy as np
 import pjsua2 as pj
-import soundfile as sf
-from streamsad import SAD
 
+from audio_capture import AudioFramePort
 from audio_matching import AudioMatching
-from config import AIEndpoints, Algorithm
+from config import AIEndpoints, Algorithm, Decision, UserAgent
 from custom_callbacks import Call
+from decision_engine import DecisionEngine
+from keyword_matcher import get_keyword_matcher
+from playback import BufferPlayerPort, get_playback_cache
+from speech_segmenter import SpeechSegmenter
+from streaming_kws import StreamingKWS
+from tracing import StageTracer
 from utils import (
     aggregate_kws_results,
-    convert_np_array_to_wav_file_bytes,
     detect_gender,
-    get_am_keywords,
+    encode_am_segment,
     get_amd_record,
-    get_background_noise,
+    get_kws_decoder_factory,
     get_logger,
     get_number,
-    get_sad_audio_buffer_duration,
-    parse_new_frames,
-    recover_asr_kws_results,
-    recover_keys_and_results,
-    spawn_background_am_asr_kws,
+    get_segment_result,
+    submit_am_asr_kws,
 )
 
+# shared by all calls for the I/O bound steps around the decision
+io_executor = ThreadPoolExecutor(
+    max_workers=UserAgent.io_workers,
+    thread_name_prefix="amd-io",
+)
+
+
+@dataclass
+class DetectionServices:
+    """Steps of the detection that reach other services; the replay benchmark swaps in stand-ins.
+
+    Attributes:
+        submit_segment: (data, call_id, segment_number) -> future of the segment result, see
+            `utils.get_segment_result`
+        lookup_history: dialed_number -> latest `utils.CallHistory` of the number, or None
+        detect_gender: (sad, sad_results, fs) -> path of the gender playback, or ""
+        match_audio: (key_segment, old_call_id, dialed_number) -> whether the key segment is found
+            in the previous call; None for `AudioMatching.match_segments`
+        clock, sleep, wait_futures: time source of the call, its sleep and `concurrent.futures.wait`
+            on segment futures; the replay benchmark runs calls on a virtual clock
+    """
+
+    submit_segment: Callable = submit_am_asr_kws
+    lookup_history: Callable = get_amd_record
+    detect_gender: Callable = detect_gender
+    match_audio: Callable | None = None
+    clock: Callable = time.time
+    sleep: Callable = time.sleep
+    wait_futures: Callable = wait
 
-def detect_answering_machine(call: Call) -> None:
-    """Detect answering machine."""
+
+def detect_answering_machine(call: Call, tracer: StageTracer | None = None) -> None:
+    """Detect answering machine, recording stage timings in `tracer`."""
     logger = get_logger()
-    am_keywords = get_am_keywords()
+    tracer = tracer or StageTracer()
     call_info = call.getInfo()
     call_id = call_info.callIdString
     logger.info(f"Call ID: {call_id}")
     dialed_number = get_number(call_info.remoteUri)
     logger.info(f"Dialed number: {dialed_number}")
-    metadata_dict = {
-        "call_id": call_id,
-        "dialed_number": dialed_number,
-        "asr_result": "",
-        "kws_result": {},
-        "result": "",
-    }
 
-    # audio recorder
+    # audio recorder: written by the media thread, only used for storage
     wav_writer = pj.AudioMediaRecorder()
     wav_filename = call_id + ".wav"
     wav_writer.createRecorder(wav_filename)
-    time.sleep(0.1)
+
+    # in-memory frame sink feeding the SAD loop
+    fs = Algorithm.sample_rate
+    frame_port = AudioFramePort(fs, Algorithm.capture_buffer_duration)
+    frame_port.create(f"amd-{call_id}")
 
     # capture audio media
     aud_med = call.getAudioMedia(0)
     aud_med.startTransmit(wav_writer)
+    aud_med.startTransmit(frame_port)
 
     # start playing background noise
-    playback_path, playback_name = get_background_noise()
-    metadata_dict["playback"] = playback_name
-    if playback_path:
+    playback_cache = get_playback_cache()
+    playback_clip = playback_cache.choose(Algorithm.background_noise_dir)
+    background_playback = playback_clip.name if playback_clip else ""
+    if playback_clip:
+        logger.info(f"{playback_clip.name = }")
+        logger.info(f"playback time: {playback_clip.duration}")
+        player = BufferPlayerPort(playback_clip)
+        player.create(f"background-{call_id}")
+        player.startTransmit(aud_med)
+    else:
+        logger.info("No playback...")
+
+    # Note: frames are pushed every 20 ms by the media thread (jitter absolutely possible!)
+    metadata_dict, gender_future = run_detection(
+        call_id, dialed_number, frame_port.read, tracer
+    )
+    metadata_dict["playback"] = background_playback
+
+    # delete pjsua objects
+    if playback_clip:
+        player.stopTransmit(aud_med)
+        del player
+    aud_med.stopTransmit(wav_writer)
+    aud_med.stopTransmit(frame_port)
+    del frame_port
+
+    # detect gender
+    if gender_future is not None:
+        with tracer.span("gender_wait"):
+            playback_path = gender_future.result()
+    else:
+        playback_path = ""
+    logger.info(f"gender playback: {playback_path}")
+    metadata_dict["gender"] = playback_path
+    playback_clip = playback_cache.get(playback_path) if playback_path else None
+    if playback_clip:
         logger.info(f"{playback_path = }")
-        playback_info = sf.info(playback_path)
-        logger.info(f"playback time: {playback_info.duration}")
-        player = pj.AudioMediaPlayer()
-        player.createPlayer(playback_path, pj.PJMEDIA_FILE_NO_LOOP)
+        logger.info(f"playback time: {playback_clip.duration}")
+        player = BufferPlayerPort(playback_clip)
+        player.create(f"gender-{call_id}")
         player.startTransmit(aud_med)
+        with tracer.span("gender_playback"):
+            time.sleep(playback_clip.duration)
+        player.stopTransmit(aud_med)
+        del player
     else:
         logger.info("No playback...")
 
-    # wait till wav file is created
-    wav_info = None
-    while wav_info is None:
-        try:
-            wav_info = sf.info(wav_filename)
-            # assume wav subtype is PCM_16 with sampling rate of 16 kHz
-            wav_file = open(wav_filename, "rb")
-            wav_file.read(44)
-        except sf.LibsndfileError:
-            time.sleep(0.01)
-    fs = wav_info.samplerate
+    metadata_dict["stages"] = tracer.summary()
+    logger.info("Return to UA")
+    return metadata_dict
+
+
+def run_detection(
+    call_id: str,
+    dialed_number: str,
+    read_audio: Callable[[float], bytes],
+    tracer: StageTracer,
+    services: DetectionServices | None = None,
+):
+    """Listen to the audio of a call and decide whether it is an answering machine.
+
+    Shared by live calls and the replay benchmark, which reads recorded audio
+    and uses stand-in services.
+
+    Args:
+        call_id (str): call id, used for the segment audit
+        dialed_number (str): dialed number, used for the call history
+        read_audio (Callable[[float], bytes]): returns the new 16 bit PCM audio of the call,
+            waiting up to the given seconds for some
+        tracer (StageTracer): records the stage timings
+        services (DetectionServices | None): services of the detection steps. Defaults to the live ones.
+
+    Returns:
+        tuple[dict, Future | None]: call metadata, and the gender detection still in progress, if any
+    """
+    logger = get_logger()
+    services = services or DetectionServices()
+    keyword_matcher = get_keyword_matcher()
+    # fetch history in background as soon as the dialed number is known
+    history_future = io_executor.submit(
+        tracer.traced("history_lookup", services.lookup_history), dialed_number
+    )
+    metadata_dict = {
+        "call_id": call_id,
+        "dialed_number": dialed_number,
+        "asr_result": "",
+        "kws_result": {},
+        "result": "",
+    }
 
     # gather first few seconds of the call
-    # Note: each packet appended every 100-120 ms (jitter absolutely possible!)
-    sad = SAD()
-    sad_results = []
-    process_list = []
-    break_while = False
-    t0 = time.time()
-    time.sleep(Algorithm.receiving_silent_segment_sleep)
-    while time.time() - t0 < Algorithm.max_call_duration:
-        # check process list for early AM detection
-        logger.info(f"process list check...")
-        for index, process in enumerate(process_list):
-            logger.info(f"Process {process.pid} is alive: {process.is_alive()}")
-            if not process.is_alive():
-                _, kws_results = recover_keys_and_results(f"kws_{call_id}_{index}_*")
-                kws_result = kws_results[0]
-                kws_result = json.loads(kws_result)
-                if len(kws_result) > 0:
-                    logger.info(f"Early AM detection @KWS")
-                    metadata_dict["reason"] = "early kws"
-                    break_while = True
-                    break
-                _, asr_results = recover_keys_and_results(f"asr_{call_id}_{index}_*")
-                asr_result = asr_results[0]
-                kw_in_asr_result = any([kw in asr_result for kw in am_keywords])
-                if kw_in_asr_result:
-                    logger.info(f"Early AM detection @ASR")
-                    metadata_dict["reason"] = "early asr"
-                    break_while = True
-                    break
-        if break_while:
+    fs = Algorithm.sample_rate
+    future_list = []
+    # segment futures whose result the engine already has
+    scored_futures = set()
+    audio_segment = None
+    streaming_kws = None
+    if AIEndpoints.am_streaming:
+        streaming_kws = StreamingKWS(fs, get_kws_decoder_factory())
+    segmenter = SpeechSegmenter(
+        fs, int(fs * Algorithm.capture_buffer_duration), tracer, streaming_kws
+    )
+    engine = DecisionEngine()
+    t0 = services.clock()
+    services.sleep(Algorithm.receiving_silent_segment_sleep)
+    while services.clock() - t0 < Algorithm.max_call_duration:
+        # score finished segments for early AM detection
+        logger.info("segment futures check...")
+        for index, future in enumerate(future_list):
+            logger.info(f"Segment {index} is done: {future.done()}")
+            if future.done() and future not in scored_futures:
+                scored_futures.add(future)
+                asr_result, kws_result, _, _ = get_segment_result(future)
+                engine.add_segment_result(asr_result, kws_result, keyword_matcher)
+        if streaming_kws is not None:
+            engine.add("streaming_kws", streaming_kws.keywords_detected())
+        if engine.is_conclusive():
+            logger.info(f"Early AM detection @{engine.reason()}")
+            metadata_dict["reason"] = f"early {engine.reason()}"
             break
         # read new segments
-        appended_bytes = wav_file.read()
+        appended_bytes = read_audio(Algorithm.chunk_interval)
         if len(appended_bytes) == 0:
-            logger.info("Pooling for audio data...")
-            time.sleep(Algorithm.chunk_interval)
+            logger.info("Waiting for audio data...")
             continue
-        new_buffer = parse_new_frames(appended_bytes, wav_info)
-        sad_result = sad(new_buffer)
-        sad_results.extend(sad_result)
+        segment = segmenter.feed(appended_bytes)
         # calculate trailing silence
-        audio_buffer_duration = get_sad_audio_buffer_duration(sad, fs)
-        last_segment_end = sad_results[-1]["end"] if sad_results else 0.0
-        tail_sil = audio_buffer_duration - last_segment_end
+        tail_sil = segmenter.tail_silence()
         if (
-            len(sad_result) == 0
+            segment is None
             and tail_sil > Algorithm.max_tail_sil
-            and len(process_list) > 0
-            and not sad.triggered
+            and len(future_list) > 0
+            and not segmenter.triggered
         ):
             logger.info("Silenced for a long time...")
             break
-        if sad_result:
+        if segment is not None:
             logger.info(f"{tail_sil = }")
             # receiving segment
-            logger.info(f"Silenced for a short time...")
-            audio_segment = sad.get_audio(sad_result[0])
-            data = convert_np_array_to_wav_file_bytes(audio_segment, fs)
-            # spawn ASR and KWS processes
-            segment_number = len(process_list)
-            process = spawn_background_am_asr_kws(data, call_id, segment_number)
-            process_list.append(process)
+            logger.info("Silenced for a short time...")
+            audio_segment = segment
+            with tracer.span("encode_segment"):
+                data = encode_am_segment(audio_segment, fs)
+            # submit ASR and KWS to the worker pool
+            segment_number = len(future_list)
+            future = services.submit_segment(data, call_id, segment_number)
+            future_list.append(future)
             # reset audio buffer
-            time.sleep(Algorithm.receiving_silent_segment_sleep)
-        elif len(process_list) == 0:
+            services.sleep(Algorithm.receiving_silent_segment_sleep)
+        elif len(future_list) == 0:
             logger.info("No activity detected yet! Going to a long sleep")
-            time.sleep(Algorithm.receiving_silent_segment_sleep)
+            services.sleep(Algorithm.receiving_silent_segment_sleep)
 
     # evacuate audio buffer in case the call is too long and the last segment is not detected via max_tail_sil
-    if time.time() - t0 > Algorithm.max_call_duration and sad.triggered:
-        sad_result = sad(np.zeros(16000))
-        if sad_result:
-            # audio_buffer = sad_result[0]["audio"]
-            audio_buffer = sad.get_audio(sad_result[0])
-            data = convert_np_array_to_wav_file_bytes(audio_buffer, fs)
-            # spawn ASR and KWS processes
-            segment_number = len(process_list)
-            process = spawn_background_am_asr_kws(data, call_id, segment_number)
-            process_list.append(process)
+    if services.clock() - t0 > Algorithm.max_call_duration:
+        audio_buffer = segmenter.flush()
+        if audio_buffer is not None:
+            with tracer.span("encode_segment"):
+                data = encode_am_segment(audio_buffer, fs)
+            # submit ASR and KWS to the worker pool
+            segment_number = len(future_list)
+            future = services.submit_segment(data, call_id, segment_number)
+            future_list.append(future)
 
     # update metadata dict
+    sad_results = segmenter.sad_results
     metadata_dict["sad_result"] = sad_results
-    metadata_dict["duration"] = time.time() - t0
+    metadata_dict["duration"] = services.clock() - t0
+    tracer.record("listen", metadata_dict["duration"])
     logger.info(f"{sad_results = }")
 
-    # fetch history
-    old_amd_record = get_amd_record(dialed_number)
-    try:
-        old_asr_result = old_amd_record.asr_result
-        logger.info(f"{old_asr_result = }")
-        old_wav_obj = old_amd_record.call_id + ".wav"
-        logger.info(f"{old_wav_obj = }")
-    except Exception as e:
-        logger.warning(f"{e = }")
-        old_asr_result = ""
-        old_wav_obj = ""
-
-    # retrieve ASR result
-    t1 = time.time()
-    while any([process.is_alive() for process in process_list]):
-        time.sleep(0.1)
-        if time.time() - t1 > AIEndpoints.timeout:
+    # verdict reached during the SAD loop, skip the remaining work
+    early_verdict = engine.is_conclusive()
+    logger.info(f"{early_verdict = }")
+
+    # detect gender in background, its playback follows the verdict
+    gender_future = None
+    if sad_results and (
+        not early_verdict or Decision.gender_playback_on_early_verdict
+    ):
+        gender_future = io_executor.submit(
+            tracer.traced("gender_detection", services.detect_gender),
+            segmenter.sad,
+            sad_results,
+            fs,
+        )
+
+    # fetch history and start audio pattern matching in background
+    old_asr_result = ""
+    matching_future = None
+    if early_verdict:
+        history_future.cancel()
+    else:
+        with tracer.span("history_wait"):
+            old_amd_record = history_future.result()
+        try:
+            old_asr_result = old_amd_record.asr_result
+            logger.info(f"{old_asr_result = }")
+            old_call_id = old_amd_record.call_id
+            logger.info(f"{old_call_id = }")
+        except Exception as e:
+            logger.warning(f"{e = }")
+            old_asr_result = ""
+            old_call_id = ""
+        if audio_segment is not None:
+            match_audio = services.match_audio or AudioMatching().match_segments
+            matching_future = io_executor.submit(
+                tracer.traced("audio_matching", match_audio),
+                audio_segment,
+                old_call_id,
+                dialed_number,
+            )
+
+    # score segment results as they arrive, until conclusive or timed out
+    t1 = services.clock()
+    pending = set(future_list) - scored_futures
+    while pending and not engine.is_conclusive():
+        remaining = max(0.0, t1 + AIEndpoints.timeout - services.clock())
+        done, pending = services.wait_futures(
+            pending, timeout=remaining, return_when=FIRST_COMPLETED
+        )
+        if not done:
             logger.info("ASR and KWS takes too long to finish...")
-            metadata_dict["last_segment_retrieve"] = time.time() - t1
+            metadata_dict["last_segment_retrieve"] = services.clock() - t1
             break
-    process_duration = time.time() - t1
-    asr_segment_results, kws_segment_results = recover_asr_kws_results(call_id)
+        for future in done:
+            asr_result, kws_result, _, _ = get_segment_result(future)
+            engine.add_segment_result(asr_result, kws_result, keyword_matcher)
+    # cancel outstanding work, results of running segments are ignored
+    for future in pending:
+        future.cancel()
+    process_duration = services.clock() - t1
+    tracer.record("segment_results_wait", process_duration)
+    segment_results = [
+        get_segment_result(future)
+        for future in future_list
+        if future.done() and not future.cancelled()
+    ]
+    # AM, ASR, KWS and Redis timings measured by the segment workers
+    for _, _, segment_timings, _ in segment_results:
+        tracer.merge(segment_timings)
+    asr_segment_results = [asr_result for asr_result, _, _, _ in segment_results]
+    kws_segment_results = [kws_result for _, kws_result, _, _ in segment_results]
     asr_result = " ".join(asr_segment_results)
     kws_result = aggregate_kws_results(kws_segment_results)
 
@@ -198,61 +340,48 @@ def detect_answering_machine(call: Call) -> None:
 
     # asr string matching
     asr_repeat = (old_asr_result == asr_result) and (len(asr_result) > 0)
+    engine.add("asr_repeat", asr_repeat)
     logger.info(f"{asr_repeat = }")
     metadata_dict["asr_repeat"] = asr_repeat
 
     # keyword spotting
     keywords_detected = len(kws_result) > 0
+    if streaming_kws is not None:
+        metadata_dict["streaming_kws_result"] = streaming_kws.kws_result
+        keywords_detected = keywords_detected or streaming_kws.keywords_detected()
+        streaming_kws.close()
     logger.info(f"{keywords_detected = }")
     metadata_dict["keywords_detected"] = keywords_detected
 
-    # audio pattern matching
-    audio_matching = AudioMatching()
-    matching_result = audio_matching.match_segments(audio_segment, old_wav_obj)
-    logger.info(f"{matching_result = }")
-    metadata_dict["matching_result"] = matching_result
-
     # search keywords in ASR result
-    kw_in_asr_result = any([keyword in asr_result for keyword in am_keywords])
-    logger.info(f"{kw_in_asr_result = }")
+    asr_keyword_matches = keyword_matcher.find(asr_result)
+    kw_in_asr_result = len(asr_keyword_matches) > 0
+    engine.add("asr_keyword", kw_in_asr_result)
+    logger.info(f"{asr_keyword_matches = }")
     metadata_dict["kw_in_asr_result"] = kw_in_asr_result
+    metadata_dict["asr_keyword_matches"] = asr_keyword_matches
+
+    # audio pattern matching, only waited for while the verdict is open
+    matching_result = None
+    if matching_future is not None:
+        if engine.is_conclusive():
+            matching_future.cancel()
+        else:
+            with tracer.span("audio_matching_wait"):
+                matching_result = matching_future.result()
+            engine.add("audio_match", matching_result)
+    logger.info(f"{matching_result = }")
+    metadata_dict["matching_result"] = matching_result
 
     # ensemble of results
-    if asr_repeat or keywords_detected or matching_result or kw_in_asr_result:
-        metadata_dict["result"] = "AMD"
-    else:
-        metadata_dict["result"] = "non-AMD"
+    metadata_dict["result"] = engine.verdict()
+    metadata_dict["evidence"] = engine.evidence
+    metadata_dict["decision_score"] = engine.score()
     metadata_dict["process_duration"] = process_duration
+    tracer.record("time_to_decision", services.clock() - t0)
     logger.warning(f"{process_duration = }")
     logger.info(f"{metadata_dict['result'] = }")
 
     # log and return
     logger.info(f"{metadata_dict = }")
-    # delete pjsua objects
-    if playback_path:
-        player.stopTransmit(aud_med)
-        del player
-    aud_med.stopTransmit(wav_writer)
-
-    # detect gender
-    if sad_results:
-        playback_path = detect_gender(sad, sad_results, fs)
-    else:
-        playback_path = ""
-    logger.info(f"gender playback: {playback_path}")
-    metadata_dict["gender"] = playback_path
-    if playback_path:
-        logger.info(f"{playback_path = }")
-        playback_info = sf.info(playback_path)
-        logger.info(f"playback time: {playback_info.duration}")
-        player = pj.AudioMediaPlayer()
-        player.createPlayer(playback_path, pj.PJMEDIA_FILE_NO_LOOP)
-        player.startTransmit(aud_med)
-        time.sleep(playback_info.duration)
-        player.stopTransmit(aud_med)
-        del player
-    else:
-        logger.info("No playback...")
-
-    logger.info("Return to UA")
-    return metadata_dict
+    return metadata_dict, gender_future
@@ -43,12 +43,14 @@ for call in calls:
         ObjectStorage.minio_metadata_bucket_name,
         call_id + ".json",
     )
+    metadata = json.loads(metadata.read())
     with open(f"objects/{call_id}.json", "w") as f:
-        json.dump(json.loads(metadata.read()), f, indent=4)
-    # fetch wav file
+        json.dump(metadata, f, indent=4)
+    # fetch recording (wav, or flac/ogg when stored compressed)
+    object_name = metadata.get("recording", {}).get("object_name", call_id + ".wav")
     wav = client.get_object(
         ObjectStorage.minio_wav_bucket_name,
-        call_id + ".wav",
+        object_name,
     )
-    with open(f"objects/{call_id}.wav", "wb") as f:
+    with open(f"objects/{object_name}", "wb") as f:
         f.write(wav.read())
@@ -0,0 +1,90 @@
+# Aho-Corasick keyword matcher for ASR transcripts
+
+import threading
+from collections import deque
+
+from config import KWSConfig
+from utils import get_keyword_cache
+
+_matcher = None
+_matcher_version = None
+_matcher_lock = threading.Lock()
+
+
+class KeywordMatcher:
+    def __init__(self, keywords: list[str], word_boundary: bool = True):
+        """Multi-pattern matcher finding all keywords in a text in a single pass.
+
+        Args:
+            keywords (list[str]): keywords to search for
+            word_boundary (bool, optional): only report matches that start and end on word
+                boundaries, so "NUMBER" is not found in "NUMBERS". Defaults to True.
+        """
+        self.keywords = [keyword for keyword in dict.fromkeys(keywords) if keyword]
+        self.word_boundary = word_boundary
+        # trie: per state its transitions, failure link and keywords ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(index)
+        # failure links in breadth first order
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = (
+                    self.output[next_state] + self.output[self.fail[next_state]]
+                )
+
+    @staticmethod
+    def _is_boundary(text: str, position: int) -> bool:
+        return position < 0 or position >= len(text) or not text[position].isalnum()
+
+    def find(self, text: str) -> list[dict]:
+        """Return all matches as {"keyword", "start", "end"} dicts, in order of their end."""
+        matches = []
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for index in self.output[state]:
+                keyword = self.keywords[index]
+                start = position - len(keyword) + 1
+                if self.word_boundary and not (
+                    self._is_boundary(text, start - 1)
+                    and self._is_boundary(text, position + 1)
+                ):
+                    continue
+                matches.append({"keyword": keyword, "start": start, "end": position + 1})
+        return matches
+
+    def search(self, text: str) -> bool:
+        return len(self.find(text)) > 0
+
+
+def get_keyword_matcher() -> KeywordMatcher:
+    """Get the matcher of the current keyword list, rebuilt when the list version changes."""
+    global _matcher, _matcher_version
+    # version and keywords come from one snapshot, a matcher is never labelled with another list
+    version, keywords = get_keyword_cache().snapshot()
+    with _matcher_lock:
+        # keep a matcher built meanwhile by another thread from a newer list
+        if _matcher is None or version > _matcher_version:
+            _matcher = KeywordMatcher(keywords, KWSConfig.asr_word_boundary)
+            _matcher_version = version
+        return _matcher
@@ -2,6 +2,7 @@
 import os
 import sys
 from datetime import datetime, timedelta
+from hashlib import sha1
 from pathlib import Path
 
 from flask import (
@@ -169,7 +170,11 @@ def add_pending_keywords():
 @app.route("/api/get_keywords", methods=["GET"])
 @jwt_required()
 def api_get_keywords():
-    return jsonify(get_confirmed_words())
+    confirmed_words = get_confirmed_words()
+    response = jsonify(confirmed_words)
+    # let agents poll cheaply with If-None-Match
+    response.set_etag(sha1("\n".join(confirmed_words).encode()).hexdigest())
+    return response.make_conditional(request)
 
 
 @app.route("/api/add_pending_keywords", methods=["POST"])
@@ -0,0 +1,253 @@
+# Stand-in of the AI services (acoustic model, ASR decoder, gender detection) for load tests
+
+import io
+import json
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from base64 import b64encode
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+from flask import Flask, Response, abort, jsonify, request
+
+from config import KWSConfig
+from utils import (
+    AM_POSTERIORS_CONTENT_TYPE,
+    AM_POSTERIORS_MAGIC,
+    PCM_SEGMENT_MAGIC,
+    decode_am_result,
+    decode_pcm_segment,
+    encode_am_posteriors,
+    get_logger,
+)
+
+app = Flask(__name__)
+stats = defaultdict(lambda: {"requests": 0, "errors": 0, "total_latency": 0.0})
+stats_lock = threading.Lock()
+
+
+class LatencyDistribution:
+    def __init__(self, spec: str):
+        """Response delay in seconds, sampled from a distribution given as "<kind>:<params>".
+
+        Kinds: fixed:<seconds>, uniform:<low>,<high>, normal:<mean>,<std>,
+        lognormal:<median>,<sigma> and exponential:<mean>. Negative samples are
+        clipped to zero.
+        """
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(param) for param in params.split(",") if param]
+        if kind not in ("fixed", "uniform", "normal", "lognormal", "exponential"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        match self.kind:
+            case "fixed":
+                delay = self.params[0]
+            case "uniform":
+                delay = random.uniform(*self.params)
+            case "normal":
+                delay = random.gauss(*self.params)
+            case "lognormal":
+                median, sigma = self.params
+                delay = median * random.lognormvariate(0, sigma)
+            case "exponential":
+                delay = random.expovariate(1 / self.params[0])
+        return max(0.0, delay)
+
+
+class MockEndpoint:
+    def __init__(self, name: str, latency: str, error_rate: float):
+        """Latency and failure model of one endpoint; failures answer HTTP 500."""
+        self.name = name
+        self.latency = LatencyDistribution(latency)
+        self.error_rate = error_rate
+
+    def delay(self):
+        """Sleep for a sampled latency, then fail the request with probability `error_rate`."""
+        delay = self.latency.sample()
+        time.sleep(delay)
+        failed = random.random() < self.error_rate
+        with stats_lock:
+            stats[self.name]["requests"] += 1
+            stats[self.name]["errors"] += int(failed)
+            stats[self.name]["total_latency"] += delay
+        if failed:
+            abort(500)
+
+
+def audio_duration(data: bytes) -> float:
+    """Duration in seconds of a WAV or raw PCM segment (see utils.encode_pcm_segment)."""
+    if data.startswith(PCM_SEGMENT_MAGIC):
+        samples, sample_rate = decode_pcm_segment(data)
+        return len(samples) / sample_rate
+    info = sf.info(io.BytesIO(data))
+    return info.frames / info.samplerate
+
+
+def load_canned_call(audio_path: Path) -> dict:
+    """Canned outputs of a recording, from files next to it.
+
+    `<stem>.npy` holds AM log probabilities and `<stem>.txt` transcripts, one
+    per line; without a .txt, the ASR result of a `<stem>.json` metadata file
+    (see fetch_calls.py) is used.
+    """
+    canned = {"posteriors": None, "transcripts": None}
+    posteriors_path = audio_path.with_suffix(".npy")
+    if posteriors_path.exists():
+        canned["posteriors"] = np.load(posteriors_path).reshape(-1, KWSConfig.num_labels)
+    transcripts_path = audio_path.with_suffix(".txt")
+    metadata_path = audio_path.with_suffix(".json")
+    if transcripts_path.exists():
+        canned["transcripts"] = transcripts_path.read_text().splitlines() or [""]
+    elif metadata_path.exists():
+        canned["transcripts"] = [json.loads(metadata_path.read_text()).get("asr_result", "")]
+    return canned
+
+
+def load_canned_calls(directory: str) -> dict:
+    """Canned outputs of all recordings of a directory that have some, by file stem."""
+    calls = {}
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix not in (".npy", ".txt", ".json") or path.stem in calls:
+            continue
+        canned = load_canned_call(path)
+        if canned["posteriors"] is not None or canned["transcripts"] is not None:
+            calls[path.stem] = canned
+    return calls
+
+
+def canned_posteriors(frames: int, call: str | None = None) -> np.ndarray:
+    """Log probabilities of shape (frames, num_labels): the canned file tiled, or mostly blank."""
+    canned = app.config["CALLS"].get(call, {}).get("posteriors")
+    if canned is None:
+        canned = app.config["AM_POSTERIORS"]
+    if canned is not None:
+        return np.resize(canned, (frames, KWSConfig.num_labels)).astype(np.float32)
+    probs = np.full(
+        (frames, KWSConfig.num_labels),
+        (1 - app.config["AM_BLANK_PROB"]) / (KWSConfig.num_labels - 1),
+        dtype=np.float32,
+    )
+    probs[:, KWSConfig.blank_index] = app.config["AM_BLANK_PROB"]
+    return np.log(probs)
+
+
+@app.route("/acoustic_model", methods=["GET", "POST"])
+@app.route("/calls/<call>/acoustic_model", methods=["GET", "POST"])
+def acoustic_model(call=None):
+    app.config["ENDPOINTS"]["am"].delay()
+    data = request.get_data()
+    frames = max(1, round(audio_duration(data) * app.config["AM_FRAME_RATE"]))
+    am_out = canned_posteriors(frames, call)
+    if AM_POSTERIORS_CONTENT_TYPE in request.headers.get("Accept", ""):
+        return Response(
+            encode_am_posteriors(am_out), content_type=AM_POSTERIORS_CONTENT_TYPE
+        )
+    return b64encode(am_out.tobytes()).decode()
+
+
+@app.route("/asr_decoder", methods=["GET", "POST"])
+@app.route("/calls/<call>/asr_decoder", methods=["GET", "POST"])
+def asr_decoder(call=None):
+    app.config["ENDPOINTS"]["asr"].delay()
+    data = request.get_data()
+    if not data.startswith(AM_POSTERIORS_MAGIC):
+        data = data.decode()
+    # reject malformed posteriors as the real decoder would
+    decode_am_result(data)
+    transcripts = app.config["CALLS"].get(call, {}).get("transcripts")
+    return random.choice(transcripts or app.config["ASR_TRANSCRIPTS"])
+
+
+@app.route("/gender_detection", methods=["GET", "POST"])
+def gender_detection():
+    app.config["ENDPOINTS"]["gender"].delay()
+    return jsonify({"male": random.random()})
+
+
+@app.route("/stats")
+def show_stats():
+    with stats_lock:
+        return jsonify(
+            {
+                name: dict(
+                    endpoint,
+                    mean_latency=endpoint["total_latency"] / endpoint["requests"],
+                )
+                for name, endpoint in stats.items()
+            }
+        )
+
+
+def build_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Stand-in of the AM, ASR and gender services.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--am-latency", type=str, default="lognormal:0.05,0.3")
+    parser.add_argument("--asr-latency", type=str, default="lognormal:0.03,0.3")
+    parser.add_argument("--gender-latency", type=str, default="lognormal:0.05,0.3")
+    parser.add_argument("--am-error-rate", type=float, default=0.0)
+    parser.add_argument("--asr-error-rate", type=float, default=0.0)
+    parser.add_argument("--gender-error-rate", type=float, default=0.0)
+    parser.add_argument("--am-frame-rate", type=float, default=50.0)
+    parser.add_argument("--am-blank-prob", type=float, default=0.9)
+    parser.add_argument(
+        "--am-posteriors",
+        type=str,
+        default="",
+        help="canned log probabilities (.npy), reshaped to (-1, num_labels) and tiled",
+    )
+    parser.add_argument(
+        "--asr-transcripts",
+        type=str,
+        default="",
+        help="text file of canned transcripts, one per line, picked at random",
+    )
+    parser.add_argument(
+        "--canned-dir",
+        type=str,
+        action="append",
+        default=[],
+        help="directory of per-recording <stem>.npy / <stem>.txt outputs, served under /calls/<stem>/",
+    )
+    return parser
+
+
+def configure_app(args) -> None:
+    """Set up the endpoints and canned outputs of the app from parsed `build_parser` arguments."""
+    app.config["ENDPOINTS"] = {
+        "am": MockEndpoint("acoustic_model", args.am_latency, args.am_error_rate),
+        "asr": MockEndpoint("asr_decoder", args.asr_latency, args.asr_error_rate),
+        "gender": MockEndpoint(
+            "gender_detection", args.gender_latency, args.gender_error_rate
+        ),
+    }
+    app.config["AM_FRAME_RATE"] = args.am_frame_rate
+    app.config["AM_BLANK_PROB"] = args.am_blank_prob
+    app.config["AM_POSTERIORS"] = None
+    if args.am_posteriors:
+        app.config["AM_POSTERIORS"] = np.load(args.am_posteriors).reshape(
+            -1, KWSConfig.num_labels
+        )
+    app.config["ASR_TRANSCRIPTS"] = [""]
+    if args.asr_transcripts:
+        with open(args.asr_transcripts) as f:
+            app.config["ASR_TRANSCRIPTS"] = [line.strip() for line in f] or [""]
+    app.config["CALLS"] = {}
+    for directory in args.canned_dir:
+        app.config["CALLS"].update(load_canned_calls(directory))
+
+
+if __name__ == "__main__":
+    logger = get_logger()
+    # python mock_ai_services.py --port 8100 --am-latency lognormal:0.05,0.5
+    # then run the agent with AI_SERVICES_ADDRESS=http://127.0.0.1:8100/
+    args = build_parser().parse_args()
+    configure_app(args)
+    logger.info(f"Serving mock AI services on {args.host}:{args.port}...")
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Date, Float, Integer, Text, Time
+from sqlalchemy import Column, Date, Float, Index, Integer, Text, Time
 
 from config import Database
 from database import Base
@@ -13,6 +13,15 @@ class AMDRecord(Base):
     result = Column(Text)
     call_duration = Column(Float)
     asr_result = Column(Text)
+    # latest call per dialed number, see get_amd_record
+    __table_args__ = (
+        Index(
+            f"{Database.table_name}_history_idx",
+            "dialed_number",
+            call_date.desc(),
+            call_time.desc(),
+        ),
+    )
 
     def __init__(
         self,
@@ -0,0 +1,239 @@
+# Background persistence of finished calls: batched DB inserts, concurrent uploads, local spool
+
+import copy
+import datetime
+import json
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from audio_matching import AudioMatching
+from config import ObjectStorage, Persistence
+from tracing import StageTracer, stage_histograms
+from utils import (
+    add_call_logs_to_database,
+    call_api,
+    compress_recording,
+    get_logger,
+    store_metadata,
+    store_wav,
+)
+
+
+class PersistenceWriter:
+    def __init__(self):
+        """Persist finished calls in the background so call workers never wait for storage.
+
+        Call logs are inserted in multi-row batches of up to `Persistence.batch_size`
+        every `Persistence.flush_interval` seconds, recordings and metadata are
+        uploaded concurrently through the shared MinIO client, and whatever fails
+        is written to `Persistence.spool_dir` and retried every
+        `Persistence.retry_interval` seconds by a separate thread, so a storage
+        outage does not hold back new batches. The callback API is called once a
+        call is fully persisted.
+        """
+        self.logger = get_logger()
+        self.spool_dir = Path(Persistence.spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.queue = queue.Queue()
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=Persistence.upload_workers,
+            thread_name_prefix="amd-upload",
+        )
+        self.spool_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run,
+            name="amd-persistence",
+            daemon=True,
+        )
+        self.thread.start()
+        self.retry_thread = threading.Thread(
+            target=self._run_retries,
+            name="amd-spool-retry",
+            daemon=True,
+        )
+        self.retry_thread.start()
+
+    def submit(self, metadata_dict):
+        """Queue a finished call; its recording is expected at <call_id>.wav."""
+        self.queue.put((metadata_dict, datetime.datetime.now()))
+
+    def close(self):
+        """Flush queued calls and stop the writer."""
+        self.queue.put(None)
+        self.thread.join()
+        self.stopped.set()
+        self.retry_thread.join()
+        self.upload_executor.shutdown(wait=True)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            try:
+                item = self.queue.get(timeout=Persistence.flush_interval)
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= Persistence.batch_size:
+                        break
+                    item = self.queue.get_nowait()
+                running = item is not None
+            except queue.Empty:
+                pass
+            # a failing batch must not end persistence
+            try:
+                if batch:
+                    self._flush(batch)
+            except Exception:
+                self.logger.exception("Persistence writer iteration failed.")
+
+    def _run_retries(self):
+        # calls spooled by a previous run are retried right away
+        while True:
+            try:
+                self._retry_spool()
+            except Exception:
+                self.logger.exception("Spool retry failed.")
+            if self.stopped.wait(Persistence.retry_interval):
+                return
+
+    def _flush(self, batch):
+        upload_futures = [
+            self.upload_executor.submit(self._store_call, metadata_dict)
+            for metadata_dict, _ in batch
+        ]
+        start = time.perf_counter()
+        stored = add_call_logs_to_database(batch)
+        stage_histograms.observe("database_batch_insert", time.perf_counter() - start)
+        # spool once the upload threads are done changing the metadata
+        wait(upload_futures)
+        for future, (metadata_dict, _) in zip(upload_futures, batch):
+            if future.exception() is not None:
+                self.logger.error(
+                    f"Can not store call {metadata_dict['call_id']}.",
+                    exc_info=future.exception(),
+                )
+                self._spool_failed_call(metadata_dict)
+            elif stored and future.result():
+                # the call log row and the uploads are in place
+                self.upload_executor.submit(self._callback)
+        if not stored:
+            for metadata_dict, call_datetime in batch:
+                self._spool(metadata_dict, call_datetime, ["database"])
+
+    def _callback(self):
+        tracer = StageTracer()
+        with tracer.span("callback"):
+            call_api()
+
+    def _store_call(self, metadata_dict):
+        """Fingerprint, compress and upload a call, return whether nothing was spooled."""
+        call_id = metadata_dict["call_id"]
+        wav_path = call_id + ".wav"
+        pending = []
+        tracer = StageTracer()
+        # the recording is removed once uploaded, fingerprint it first
+        with tracer.span("fingerprint"):
+            AudioMatching().store_fingerprint(
+                wav_path,
+                call_id,
+                metadata_dict["dialed_number"],
+            )
+        if Path(wav_path).exists():
+            with tracer.span("compress_recording"):
+                recording_path, speech_regions = compress_recording(
+                    wav_path, metadata_dict.get("sad_result")
+                )
+            metadata_dict["recording"] = {
+                "object_name": recording_path,
+                "format": ObjectStorage.recording_format,
+                "speech_regions": speech_regions,
+            }
+            with tracer.span("upload_recording"):
+                stored = store_wav(recording_path)
+            if not stored:
+                shutil.move(recording_path, self.spool_dir / recording_path)
+                pending.append("wav")
+        metadata_dict.setdefault("stages", {}).update(tracer.summary())
+        with tracer.span("upload_metadata"):
+            stored = store_metadata(metadata_dict)
+        if not stored:
+            pending.append("metadata")
+        if pending:
+            self._spool(metadata_dict, None, pending)
+        return not pending
+
+    def _spool_failed_call(self, metadata_dict):
+        """Spool the recording and metadata of a call whose storage raised."""
+        pending = ["metadata"]
+        wav_path = metadata_dict["call_id"] + ".wav"
+        recording = metadata_dict.get("recording")
+        if recording is None or not Path(recording["object_name"]).exists():
+            recording = None
+            if Path(wav_path).exists():
+                recording = {
+                    "object_name": wav_path,
+                    "format": "wav",
+                    "speech_regions": None,
+                }
+                metadata_dict["recording"] = recording
+        if recording is not None:
+            object_name = recording["object_name"]
+            shutil.move(object_name, self.spool_dir / object_name)
+            pending.append("wav")
+        self._spool(metadata_dict, None, pending)
+
+    def _spool(self, metadata_dict, call_datetime, pending):
+        """Record the steps left for a call; several failures of a call are merged."""
+        spool_path = self.spool_dir / (metadata_dict["call_id"] + ".spool.json")
+        with self.spool_lock:
+            entry = {"call_datetime": None, "pending": []}
+            if spool_path.exists():
+                entry = json.loads(spool_path.read_text())
+            entry["metadata"] = copy.deepcopy(metadata_dict)
+            if call_datetime is not None:
+                entry["call_datetime"] = call_datetime.isoformat()
+            entry["pending"] = sorted(set(entry["pending"]) | set(pending))
+            spool_path.write_text(json.dumps(entry))
+        self.logger.warning(f"Spooled {pending} of call {metadata_dict['call_id']}.")
+
+    def _retry_spool(self):
+        for spool_path in sorted(self.spool_dir.glob("*.spool.json")):
+            if self.stopped.is_set():
+                return
+            try:
+                self._retry_spool_entry(spool_path)
+            except Exception:
+                self.logger.exception(f"Can not retry spool entry {spool_path}.")
+
+    def _retry_spool_entry(self, spool_path):
+        with self.spool_lock:
+            entry = json.loads(spool_path.read_text())
+        metadata_dict = entry["metadata"]
+        call_id = metadata_dict["call_id"]
+        done = set()
+        if "wav" in entry["pending"]:
+            object_name = metadata_dict["recording"]["object_name"]
+            if store_wav(str(self.spool_dir / object_name), object_name=object_name):
+                done.add("wav")
+        if "metadata" in entry["pending"] and store_metadata(metadata_dict):
+            done.add("metadata")
+        if "database" in entry["pending"]:
+            call_datetime = datetime.datetime.fromisoformat(entry["call_datetime"])
+            if add_call_logs_to_database([(metadata_dict, call_datetime)]):
+                done.add("database")
+        # the writer may have spooled more steps of the call meanwhile
+        with self.spool_lock:
+            entry = json.loads(spool_path.read_text())
+            entry["pending"] = sorted(set(entry["pending"]) - done)
+            if entry["pending"]:
+                spool_path.write_text(json.dumps(entry))
+            else:
+                spool_path.unlink()
+        if not entry["pending"]:
+            self.logger.info(f"Spooled call {call_id} persisted.")
+            self._callback()
@@ -0,0 +1,118 @@
+# In-memory playbacks: prompts are decoded once and played from a buffer port
+
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pjsua2 as pj
+import soundfile as sf
+
+from audio_capture import pcm_port_format
+from config import Algorithm, gender_confidence_list
+from utils import get_logger
+
+_playback_cache = None
+
+
+@dataclass
+class PlaybackClip:
+    name: str
+    samples: np.ndarray
+    sample_rate: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+
+class PlaybackCache:
+    def __init__(self):
+        """Decoded playback clips, keyed by path.
+
+        Clips are read once and reloaded when their file changes; directory
+        listings are refreshed when the directory modification time changes.
+        """
+        self.logger = get_logger()
+        # path -> (file mtime, clip)
+        self._clips = {}
+        # directory -> (directory mtime, paths)
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> PlaybackClip | None:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self.logger.warning(f"Playback file {path} is missing.")
+            return None
+        with self._lock:
+            cached = self._clips.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        samples, sample_rate = sf.read(path, dtype="int16", always_2d=True)
+        clip = PlaybackClip(Path(path).name, np.ascontiguousarray(samples[:, 0]), sample_rate)
+        with self._lock:
+            self._clips[path] = (mtime, clip)
+        return clip
+
+    def list_directory(self, directory: str) -> list[str]:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        with self._lock:
+            cached = self._directories.get(directory)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        paths = sorted(str(path) for path in Path(directory).glob("*.wav"))
+        with self._lock:
+            self._directories[directory] = (mtime, paths)
+        return paths
+
+    def choose(self, directory: str) -> PlaybackClip | None:
+        """Pick a random clip of a directory, None if it is empty."""
+        paths = self.list_directory(directory)
+        if not paths:
+            return None
+        return self.get(np.random.choice(paths))
+
+    def preload(self) -> None:
+        """Decode the background and gender prompts ahead of the first call."""
+        for path in self.list_directory(Algorithm.background_noise_dir):
+            self.get(path)
+        for path in gender_confidence_list:
+            self.get(path)
+
+
+def get_playback_cache() -> PlaybackCache:
+    global _playback_cache
+    if _playback_cache is None:
+        _playback_cache = PlaybackCache()
+    return _playback_cache
+
+
+class BufferPlayerPort(pj.AudioMediaPort):
+    def __init__(self, clip: PlaybackClip):
+        """Conference port playing a decoded clip once, then silence.
+
+        Args:
+            clip (PlaybackClip): clip to play, shared between calls without copy.
+        """
+        super().__init__()
+        self.clip = clip
+        self.position = 0
+
+    def create(self, name: str) -> None:
+        self.createPort(name, pcm_port_format(self.clip.sample_rate))
+
+    def onFrameRequested(self, frame):
+        """Invoked by the media thread whenever the port has to produce a frame."""
+        frame_samples = frame.size // 2
+        chunk = self.clip.samples[self.position : self.position + frame_samples]
+        self.position += len(chunk)
+        if len(chunk) < frame_samples:
+            chunk = np.pad(chunk, (0, frame_samples - len(chunk)))
+        frame.type = pj.PJMEDIA_FRAME_TYPE_AUDIO
+        frame.buf = pj.ByteVector(chunk.tobytes())
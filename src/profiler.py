@@ -0,0 +1,188 @@
+# Resource profiling of load runs: per-process and per-thread CPU, memory, files and threads
+
+import cProfile
+import json
+import pstats
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+
+import psutil
+
+
+def thread_group(name: str) -> str:
+    """Group a thread name by its role, e.g. "amd-call_3" -> "amd-call"."""
+    # foreign threads that ran Python code are pjsua threads invoking callbacks
+    if name.startswith("Dummy-"):
+        return "pjsua"
+    return re.sub(r"[-_]?\d+$", "", name) or name
+
+
+class ResourceProfiler:
+    def __init__(
+        self,
+        output_dir,
+        name,
+        interval=1.0,
+        active_calls=None,
+        cprofile=False,
+        py_spy=False,
+    ):
+        """Sample the resources of this process and its children during a load run.
+
+        Every `interval` seconds one JSON line is appended to
+        <output_dir>/<name>_resources.jsonl with the number of active calls and,
+        per process, CPU percent, RSS, open file descriptors, threads and child
+        processes. CPU of the own process is also split by thread role: Python
+        threads by name (amd-call, amd-io, sad-batcher, ...), pjsua threads that
+        invoke callbacks as "pjsua", and torch and other native threads as "native".
+
+        Args:
+            output_dir (str | Path): directory of the profile files
+            name (str): prefix of the profile files, e.g. "agent"
+            interval (float): seconds between two samples
+            active_calls (Callable[[], int] | None): current number of active calls
+            cprofile (bool): collect cProfile stats of the functions wrapped by `profiled`
+            py_spy (bool): record a py-spy flame graph of the process tree, if installed
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.name = name
+        self.interval = interval
+        self.active_calls = active_calls or (lambda: None)
+        self.process = psutil.Process()
+        self.processes = {self.process.pid: self.process}
+        self.thread_times = {}
+        self.stats = None
+        self.stats_lock = threading.Lock()
+        self.cprofile = cprofile
+        self.py_spy = None
+        if py_spy:
+            self._start_py_spy()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and write the cProfile stats and py-spy flame graph."""
+        self.stopped.set()
+        self.thread.join()
+        if self.stats is not None:
+            self.stats.dump_stats(self.output_dir / f"{self.name}.pstats")
+        if self.py_spy is not None:
+            self.py_spy.send_signal(signal.SIGINT)
+            self.py_spy.wait()
+
+    def profiled(self, function):
+        """Wrap `function` to profile each run with cProfile in the calling thread."""
+        if not self.cprofile:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profile is active (one at a time since Python 3.12)
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.stats_lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+
+        return wrapper
+
+    def _start_py_spy(self):
+        executable = shutil.which("py-spy")
+        if executable is None:
+            return
+        self.py_spy = subprocess.Popen(
+            [
+                executable,
+                "record",
+                "--pid",
+                str(self.process.pid),
+                "--subprocesses",
+                "--output",
+                str(self.output_dir / f"{self.name}_flame.svg"),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _run(self):
+        output_path = self.output_dir / f"{self.name}_resources.jsonl"
+        # prime the CPU counters, cpu_percent compares against the previous call
+        self._sample_processes()
+        self._sample_threads()
+        with open(output_path, "a") as f:
+            while not self.stopped.wait(self.interval):
+                sample = {
+                    "time": time.time(),
+                    "active_calls": self.active_calls(),
+                    "processes": self._sample_processes(),
+                    "threads": self._sample_threads(),
+                }
+                f.write(json.dumps(sample) + "\n")
+                f.flush()
+
+    def _sample_processes(self):
+        # keep psutil.Process objects across samples for their CPU counters
+        try:
+            children = self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        for child in children:
+            self.processes.setdefault(child.pid, child)
+        samples = []
+        for pid, process in list(self.processes.items()):
+            try:
+                with process.oneshot():
+                    samples.append(
+                        {
+                            "pid": pid,
+                            "name": process.name(),
+                            "main": pid == self.process.pid,
+                            "cpu_percent": process.cpu_percent(),
+                            "rss": process.memory_info().rss,
+                            "open_files": process.num_fds(),
+                            "threads": process.num_threads(),
+                            "children": len(process.children()),
+                        }
+                    )
+            except psutil.NoSuchProcess:
+                del self.processes[pid]
+        return samples
+
+    def _sample_threads(self):
+        """CPU percent of the own process per thread role since the previous sample."""
+        now = time.time()
+        names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        groups = {}
+        thread_times = {}
+        for thread in self.process.threads():
+            cpu_time = thread.user_time + thread.system_time
+            thread_times[thread.id] = (cpu_time, now)
+            previous_cpu_time, previous_time = self.thread_times.get(
+                thread.id, (cpu_time, now)
+            )
+            if now <= previous_time:
+                continue
+            group = thread_group(names.get(thread.id, "native"))
+            cpu_percent = 100 * (cpu_time - previous_cpu_time) / (now - previous_time)
+            groups[group] = groups.get(group, 0.0) + cpu_percent
+        self.thread_times = thread_times
+        return groups
@@ -0,0 +1,386 @@
+# Replay benchmark: recorded calls through the detection of live calls, against local stand-in services
+
+import datetime
+import heapq
+import itertools
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+from werkzeug.serving import make_server
+
+import mock_ai_services
+from audio_matching import AudioMatching
+from config import AIEndpoints, Algorithm, KWSConfig
+from detection_algorithm import DetectionServices, run_detection
+from tracing import StageTracer
+from utils import (
+    CallHistory,
+    endpoint_metrics,
+    get_keyword_cache,
+    get_logger,
+    init_segment_worker,
+    run_am_asr_kws,
+)
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".ogg", ".gsm"}
+# label of recordings without metadata, by file stem (playbacks/answers/am.gsm, live.gsm)
+STEM_LABELS = {"am": "AMD", "live": "non-AMD"}
+
+
+@dataclass
+class ReplayCall:
+    """A recorded call, its label and the dialed number it is replayed as."""
+
+    name: str
+    stem: str
+    audio: np.ndarray
+    label: str | None
+    dialed_number: str
+
+
+def load_audio(path: Path, fs: int) -> np.ndarray:
+    """Read a recording as mono float32 at `fs`; .gsm files are headerless 8 kHz GSM 6.10."""
+    if path.suffix == ".gsm":
+        audio, sample_rate = sf.read(
+            path,
+            format="RAW",
+            subtype="GSM610",
+            samplerate=8000,
+            channels=1,
+            dtype="float32",
+        )
+    else:
+        audio, sample_rate = sf.read(path, dtype="float32", always_2d=True)
+        audio = audio[:, 0]
+    if sample_rate != fs:
+        audio = torchaudio.functional.resample(
+            torch.from_numpy(audio), sample_rate, fs
+        ).numpy()
+    return audio
+
+
+def load_calls(paths: list[str]) -> list[ReplayCall]:
+    """Load recordings from files or directories, with their metadata when present.
+
+    A `<stem>.json` next to a recording (as written by fetch_calls.py) provides
+    the label ("result") and the dialed number; otherwise the label follows
+    `STEM_LABELS` and the dialed number is the file stem.
+    """
+    fs = Algorithm.sample_rate
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.iterdir() if p.suffix in AUDIO_EXTENSIONS))
+        else:
+            files.append(path)
+    calls = []
+    for path in files:
+        call = ReplayCall(
+            path.name, path.stem, load_audio(path, fs), STEM_LABELS.get(path.stem), path.stem
+        )
+        metadata_path = path.with_suffix(".json")
+        if metadata_path.exists():
+            metadata = json.loads(metadata_path.read_text())
+            if metadata.get("result") in ("AMD", "non-AMD"):
+                call.label = metadata["result"]
+            call.dialed_number = metadata.get("dialed_number") or call.dialed_number
+        calls.append(call)
+    return calls
+
+
+class VirtualClock:
+    def __init__(self):
+        """Call time of a replayed call, advanced by its sleeps and reads instead of passing.
+
+        Segment results are computed right away and released once the call time
+        reaches their submission time plus the wall time they took, so service
+        latency counts as on a live call while listening costs no wall time.
+        """
+        self.now = 0.0
+        # (ready_time, sequence, future, result, exception)
+        self.scheduled = []
+        self.sequence = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.advance(self.now + seconds)
+
+    def advance(self, until: float) -> None:
+        """Move the call time forward, releasing the segment results ready by then."""
+        self.now = max(self.now, until)
+        while self.scheduled and self.scheduled[0][0] <= self.now:
+            _, _, future, result, exception = heapq.heappop(self.scheduled)
+            # the call cancels the segments it stopped waiting for
+            if not future.set_running_or_notify_cancel():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def schedule(self, function, *args) -> Future:
+        """Run `function` now and release its result after the wall time it took."""
+        start = time.perf_counter()
+        result, exception = None, None
+        try:
+            result = function(*args)
+        except Exception as e:
+            exception = e
+        future = Future()
+        ready_time = self.now + time.perf_counter() - start
+        heapq.heappush(
+            self.scheduled, (ready_time, next(self.sequence), future, result, exception)
+        )
+        return future
+
+    def wait(self, futures, timeout=None, return_when=None):
+        """`concurrent.futures.wait` for the first scheduled result, in call time."""
+        futures = set(futures)
+        if not any(future.done() for future in futures):
+            ready_times = [
+                ready_time for ready_time, _, future, _, _ in self.scheduled if future in futures
+            ]
+            if timeout is not None:
+                ready_times.append(self.now + timeout)
+            if ready_times:
+                self.advance(min(ready_times))
+        done = {future for future in futures if future.done()}
+        return done, futures - done
+
+
+class ReplayAudio:
+    def __init__(self, audio: np.ndarray, fs: int, clock: VirtualClock):
+        """Deliver a recording as the frame port delivers a live call, on a virtual clock.
+
+        Audio becomes readable as the call time passes, in 20 ms frames, and is
+        followed by silence as the line stays open after the greeting.
+        """
+        self.pcm = (np.clip(audio, -1, 1 - 2**-15) * 2**15).astype(np.int16).tobytes()
+        self.fs = fs
+        self.clock = clock
+        self.frame_duration = 0.02
+        self.position = 0
+
+    def available(self) -> int:
+        frames = int(self.clock.time() / self.frame_duration)
+        return int(frames * self.frame_duration * self.fs) - self.position
+
+    def read(self, timeout: float) -> bytes:
+        """Return all unread samples as PCM bytes, advancing the clock to the next frame if there are none."""
+        if self.available() <= 0:
+            self.clock.sleep(min(timeout, self.frame_duration))
+        size = max(0, self.available())
+        chunk = self.pcm[2 * self.position : 2 * (self.position + size)]
+        self.position += size
+        return chunk + bytes(2 * size - len(chunk))
+
+
+class ReplayHistory:
+    def __init__(self, enabled: bool):
+        """Stand-in of the call history and fingerprint store: the latest replayed call per dialed number.
+
+        When disabled, every call is the first one to its number, as repeats of
+        a recording would otherwise trigger the ASR repeat and audio match signals.
+        """
+        self.enabled = enabled
+        self.records = {}
+        self.lock = threading.Lock()
+        self.audio_matching = AudioMatching()
+
+    def lookup(self, dialed_number: str) -> CallHistory | None:
+        with self.lock:
+            return self.records.get(dialed_number)
+
+    def add(self, call: ReplayCall, call_id: str, asr_result: str) -> None:
+        if not self.enabled:
+            return
+        # cached only, matching never reaches object storage for replayed calls
+        self.audio_matching.cache_fingerprint(
+            torch.from_numpy(call.audio).unsqueeze(0), call_id, call.dialed_number
+        )
+        now = datetime.datetime.now()
+        with self.lock:
+            self.records[call.dialed_number] = CallHistory(
+                call_id, asr_result, now.date(), now.time()
+            )
+
+
+def start_mock_services(canned_dirs: list[str], latency: str) -> str:
+    """Serve `mock_ai_services` on a free local port, return its base URL."""
+    args = mock_ai_services.build_parser().parse_args(
+        ["--am-latency", latency, "--asr-latency", latency, "--gender-latency", latency]
+    )
+    args.canned_dir = canned_dirs
+    mock_ai_services.configure_app(args)
+    server = make_server("127.0.0.1", 0, mock_ai_services.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="mock-services", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def run_segment(data, am_endpoint, asr_endpoint):
+    """AM, ASR and KWS of a segment in this process, as a segment worker runs them."""
+    tracer = StageTracer(histograms=None)
+    _, asr_result, kws_result = run_am_asr_kws(data, tracer, am_endpoint, asr_endpoint)
+    return asr_result, kws_result, tracer.totals(), {}
+
+
+def replay_call(
+    call: ReplayCall,
+    index: int,
+    base_url: str,
+    per_call_routes: bool,
+    history: ReplayHistory,
+    stages: StageTracer,
+) -> dict:
+    """Run a recording through `run_detection` on a virtual clock, as a live call."""
+    call_id = f"replay-{index}-{call.stem}"
+    prefix = f"{base_url}calls/{quote(call.stem)}/" if per_call_routes else base_url
+    clock = VirtualClock()
+    segments = []
+
+    def submit_segment(data, call_id, segment_number):
+        segments.append(segment_number)
+        return clock.schedule(
+            run_segment, data, f"{prefix}acoustic_model", f"{prefix}asr_decoder"
+        )
+
+    services = DetectionServices(
+        submit_segment=submit_segment,
+        lookup_history=history.lookup,
+        match_audio=history.audio_matching.match_segments,
+        clock=clock.time,
+        sleep=clock.sleep,
+        wait_futures=clock.wait,
+    )
+    tracer = StageTracer(histograms=None)
+    audio = ReplayAudio(call.audio, Algorithm.sample_rate, clock)
+    metadata_dict, gender_future = run_detection(
+        call_id, call.dialed_number, audio.read, tracer, services
+    )
+    time_to_decision = clock.time()
+    gender = gender_future.result() if gender_future is not None else ""
+    history.add(call, call_id, metadata_dict["asr_result"])
+    stages.merge(tracer.totals())
+    return {
+        "name": call.name,
+        "label": call.label,
+        "result": metadata_dict["result"],
+        "reason": metadata_dict.get("reason", ""),
+        "evidence": metadata_dict["evidence"],
+        "asr_result": metadata_dict["asr_result"],
+        "kws_result": metadata_dict["kws_result"],
+        "gender": gender,
+        "segments": len(segments),
+        "listen_duration": metadata_dict["duration"],
+        "time_to_decision": time_to_decision,
+    }
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 90, 99)}
+
+
+def summarize(results, wall_time, stages):
+    labelled = [result for result in results if result["label"] is not None]
+    confusion = {}
+    for result in labelled:
+        key = f"{result['label']} -> {result['result']}"
+        confusion[key] = confusion.get(key, 0) + 1
+    correct = sum(result["label"] == result["result"] for result in labelled)
+    return {
+        "calls": len(results),
+        "wall_time": wall_time,
+        "calls_per_second": len(results) / wall_time,
+        # seconds of call time replayed per second of wall time
+        "realtime_factor": sum(r["time_to_decision"] for r in results) / wall_time,
+        "time_to_decision": percentiles([r["time_to_decision"] for r in results]),
+        "listen_duration": percentiles([r["listen_duration"] for r in results]),
+        "accuracy": correct / len(labelled) if labelled else None,
+        "confusion": confusion,
+        "stages": stages.summary(),
+        "endpoints": endpoint_metrics.snapshot(),
+    }
+
+
+if __name__ == "__main__":
+    logger = get_logger()
+    # python replay_benchmark.py ../playbacks/answers objects --concurrency 8 --repeat 10
+    parser = ArgumentParser(description="Replay recorded calls through the AMD pipeline.")
+    parser.add_argument("paths", nargs="+", help="recordings or directories of recordings")
+    parser.add_argument("--concurrency", type=int, default=4, help="calls replayed at once")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--services",
+        type=str,
+        default="",
+        help="base URL of running AI services; by default mock_ai_services is served in-process "
+        "with the canned <stem>.npy / <stem>.txt outputs next to the recordings",
+    )
+    parser.add_argument(
+        "--service-latency",
+        type=str,
+        default="fixed:0",
+        help="latency distribution of the in-process mock services (see mock_ai_services)",
+    )
+    parser.add_argument(
+        "--keywords",
+        type=str,
+        default="",
+        help="keyword file, one per line; defaults to KWSConfig.am_keywords, the keyword service is not used",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="replay later calls to a dialed number as repeats of the previous one, "
+        "exercising the ASR repeat and audio matching signals",
+    )
+    parser.add_argument("--output", type=str, default="", help="per-call results (JSON)")
+    args = parser.parse_args()
+
+    # keywords are injected, the keyword service is never contacted
+    keywords = KWSConfig.am_keywords
+    if args.keywords:
+        keywords = [line.strip() for line in open(args.keywords) if line.strip()]
+    get_keyword_cache().pin(keywords)
+    init_segment_worker(asr_workers=args.concurrency)
+
+    calls = load_calls(args.paths) * args.repeat
+    canned_dirs = sorted(
+        {str(path if Path(path).is_dir() else Path(path).parent) for path in args.paths}
+    )
+    base_url = args.services or start_mock_services(canned_dirs, args.service_latency)
+    AIEndpoints.am_endpoint = f"{base_url}acoustic_model"
+    AIEndpoints.asr_decoder_endpoint = f"{base_url}asr_decoder"
+    AIEndpoints.gender_detection = f"{base_url}gender_detection"
+    history = ReplayHistory(args.history)
+    stages = StageTracer(histograms=None)
+    logger.info(f"Replaying {len(calls)} calls against {base_url}...")
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda item: replay_call(
+                    item[1], item[0], base_url, not args.services, history, stages
+                ),
+                enumerate(calls),
+            )
+        )
+    summary = summarize(results, time.time() - t0, stages)
+    print(json.dumps(summary, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "calls": results}, f, indent=4)
@@ -0,0 +1,132 @@
+# Shared SAD model: one ONNX session for all calls, forward passes batched across calls
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from importlib import resources
+
+import numpy as np
+import onnxruntime as ort
+from streamsad import SAD, Config, FeatureExtractor, models
+
+from config import Algorithm
+from utils import get_logger
+
+_shared_sad_model = None
+
+
+class SharedSADModel:
+    def __init__(self, batch_window: float):
+        """SAD ONNX session loaded once and shared by every call of the process.
+
+        Forward passes requested within `batch_window` seconds of each other are
+        stacked into one batch when they have the same number of frames. If the
+        model rejects batched input, passes are run one by one from then on.
+
+        Args:
+            batch_window (float): seconds to wait for other calls before running a batch
+        """
+        self.logger = get_logger()
+        model_path = resources.files(models).joinpath(Config.model_name)
+        self.session = ort.InferenceSession(str(model_path))
+        self.batch_window = batch_window
+        self.batching = True
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="sad-batcher", daemon=True)
+        self.thread.start()
+
+    def infer(self, spect: np.ndarray, state: np.ndarray):
+        """Run the model on (1, F, T) features of one call, return (raw_output, new_state)."""
+        future = Future()
+        self.requests.put((spect, state, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.batch_window
+            while (remaining := deadline - time.time()) > 0:
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[0].shape[2], []).append(request)
+            for group in groups.values():
+                self._forward(group)
+
+    def _forward(self, group):
+        if len(group) > 1 and self.batching:
+            try:
+                raw_output, state = self.session.run(
+                    None,
+                    {
+                        "input": np.concatenate([spect for spect, _, _ in group]),
+                        "input_state": np.concatenate(
+                            [state for _, state, _ in group], axis=1
+                        ),
+                    },
+                )
+                if raw_output.shape[0] == len(group) and state.shape[1] == len(group):
+                    for index, (_, _, future) in enumerate(group):
+                        future.set_result(
+                            (raw_output[index : index + 1], state[:, index : index + 1])
+                        )
+                    return
+                self.logger.warning("SAD model output is not batched.")
+            except Exception:
+                self.logger.exception("SAD model does not accept batches.")
+            self.logger.warning("Running SAD forward passes one by one.")
+            self.batching = False
+        for spect, state, future in group:
+            try:
+                future.set_result(
+                    tuple(
+                        self.session.run(None, {"input": spect, "input_state": state})
+                    )
+                )
+            except Exception as e:
+                future.set_exception(e)
+
+
+def get_shared_sad_model() -> SharedSADModel:
+    global _shared_sad_model
+    if _shared_sad_model is None:
+        _shared_sad_model = SharedSADModel(Algorithm.sad_batch_window)
+    return _shared_sad_model
+
+
+class SharedSAD(SAD):
+    def __init__(self, model: SharedSADModel):
+        """Streaming SAD of one call, running its forward passes on a shared model.
+
+        Only the per-call streaming state of `streamsad.SAD` is created here; its
+        ONNX session is replaced by `model`.
+        """
+        self.model = model
+        self.input_audio_buffer = np.zeros(0, dtype=np.float32)
+        self.step = 0
+        self.feature_extractor = FeatureExtractor()
+        self.state = np.zeros((1, 1, 64), dtype=np.float32)
+        self.ring_buffer = deque(maxlen=Config.ring_buffer_len)
+        self.triggered = False
+        self.agg_result = []
+        self.voiced_frames = []
+
+    def __call__(self, audio_array):
+        self.input_audio_buffer = np.concatenate((self.input_audio_buffer, audio_array))
+        valid_steps = (
+            self.input_audio_buffer.shape[0] - int(self.step * Config.n_hop)
+        ) // Config.n_hop
+        # less than a hop of new audio (frames arrive every 20 ms)
+        if valid_steps == 0:
+            return []
+        start_index = int(self.step * Config.n_hop)
+        end_index = start_index + int(valid_steps * Config.n_hop)
+        spect = self.feature_extractor(self.input_audio_buffer[start_index:end_index])
+        raw_output, self.state = self.model.infer(spect, self.state)
+        sad_probs = raw_output[0, :, 1]
+        return self.apply_ring_buffer_smoothing(sad_probs)
@@ -0,0 +1,62 @@
+# Speech segmentation of the incoming audio of a call, independent of the audio source
+
+import numpy as np
+
+from shared_sad import SharedSAD, get_shared_sad_model
+from utils import FrameBuffer, get_sad_audio_buffer_duration
+
+
+class SpeechSegmenter:
+    def __init__(self, fs: int, capacity: int, tracer, streaming_kws=None):
+        """Run SAD on PCM chunks of a call and cut the speech segments sent to AM/ASR/KWS.
+
+        Used by `detect_answering_machine` on live frames and by the replay
+        benchmark on recorded audio.
+
+        Args:
+            fs (int): sampling rate of the audio
+            capacity (int): samples of the frame conversion ring
+            tracer (StageTracer): records the SAD timings
+            streaming_kws (StreamingKWS | None): fed with in-progress speech
+        """
+        self.fs = fs
+        self.sad = SharedSAD(get_shared_sad_model())
+        self.frame_buffer = FrameBuffer(capacity)
+        self.tracer = tracer
+        self.streaming_kws = streaming_kws
+        self.sad_results = []
+
+    @property
+    def triggered(self) -> bool:
+        """Whether a speech segment is in progress."""
+        return self.sad.triggered
+
+    def feed(self, appended_bytes):
+        """Run SAD on new 16 bit PCM bytes, return the audio of the segment they close, if any."""
+        samples = self.frame_buffer.parse(appended_bytes)
+        sad_result = self._run_sad(samples)
+        # stream in-progress speech to the acoustic model
+        if self.streaming_kws is not None:
+            if sad_result:
+                self.streaming_kws.end_segment()
+            elif self.sad.triggered:
+                self.streaming_kws.feed(samples)
+        return self.sad.get_audio(sad_result[0]) if sad_result else None
+
+    def flush(self):
+        """Close the in-progress segment with one second of silence, return its audio, if any."""
+        if not self.sad.triggered:
+            return None
+        sad_result = self._run_sad(np.zeros(self.fs, dtype=np.float32))
+        return self.sad.get_audio(sad_result[0]) if sad_result else None
+
+    def tail_silence(self) -> float:
+        """Seconds of audio since the end of the last segment."""
+        last_segment_end = self.sad_results[-1]["end"] if self.sad_results else 0.0
+        return get_sad_audio_buffer_duration(self.sad, self.fs) - last_segment_end
+
+    def _run_sad(self, samples):
+        with self.tracer.span("sad"):
+            sad_result = self.sad(samples)
+        self.sad_results.extend(sad_result)
+        return sad_result
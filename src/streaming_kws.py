@@ -0,0 +1,110 @@
+# Streaming keyword spotting: forward in-progress speech to the acoustic model chunk by chunk
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import Algorithm
+from utils import (
+    decode_am_result,
+    encode_am_segment,
+    filter_kws_result,
+    get_logger,
+    request_am,
+)
+
+
+class StreamingKWS:
+    def __init__(self, sample_rate: int, decoder_factory):
+        """Run AM and KWS on a speech segment while the caller is still speaking.
+
+        Audio fed during a segment is posted to the acoustic model every
+        `Algorithm.stream_chunk_duration` seconds over the pooled keep-alive session,
+        with `Algorithm.stream_context_duration` seconds of left context whose
+        posteriors are dropped. After every chunk the KWS decoder searches its
+        posteriors together with the last `Algorithm.stream_search_overlap`
+        seconds of posteriors of the same segment, so keywords spanning chunks
+        are found without searching the whole segment again.
+
+        Args:
+            sample_rate (int): sampling rate of the fed audio
+            decoder_factory (KWSDecoderFactory): source of ready KWS decoders
+        """
+        self.sample_rate = sample_rate
+        self.decoder_factory = decoder_factory
+        self.chunk_samples = int(Algorithm.stream_chunk_duration * sample_rate)
+        self.context_samples = int(Algorithm.stream_context_duration * sample_rate)
+        # a single thread keeps the chunks of a segment in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.logger = get_logger()
+        # guards the segment number, posteriors and results shared with the chunk thread
+        self._lock = threading.Lock()
+        self.segment_number = 0
+        self.kws_result = {}
+        self._reset_segment()
+
+    def _reset_segment(self):
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.context = np.zeros(0, dtype=np.float32)
+        self.posteriors_tail = None
+
+    def feed(self, samples: np.ndarray) -> None:
+        """Queue new in-segment audio, posting it once a chunk is complete."""
+        self.pending = np.concatenate([self.pending, samples])
+        if len(self.pending) < self.chunk_samples:
+            return
+        audio = np.concatenate([self.context, self.pending])
+        future = self.executor.submit(
+            self._process_chunk, audio, len(self.context), self.segment_number
+        )
+        future.add_done_callback(self._log_chunk_failure)
+        self.context = audio[-self.context_samples :]
+        self.pending = np.zeros(0, dtype=np.float32)
+
+    def end_segment(self) -> None:
+        """Forget the in-progress segment; the closed segment is handled by the worker pool."""
+        with self._lock:
+            self.segment_number += 1
+            self._reset_segment()
+
+    def keywords_detected(self) -> bool:
+        with self._lock:
+            return len(self.kws_result) > 0
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _log_chunk_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(
+                "Streaming KWS chunk failed.", exc_info=future.exception()
+            )
+
+    def _process_chunk(self, audio, context_len, segment_number):
+        data = encode_am_segment(audio, self.sample_rate)
+        am_result = request_am(data)
+        if not am_result:
+            return
+        am_out = decode_am_result(am_result)
+        # drop the posteriors of the left context
+        context_frames = round(context_len * am_out.shape[0] / len(audio))
+        overlap_frames = round(
+            Algorithm.stream_search_overlap * self.sample_rate * am_out.shape[0] / len(audio)
+        )
+        with self._lock:
+            # the segment ended while the chunk was in flight
+            if segment_number != self.segment_number:
+                return
+            posteriors = am_out[context_frames:]
+            if self.posteriors_tail is not None:
+                posteriors = np.concatenate([self.posteriors_tail, posteriors])
+            self.posteriors_tail = posteriors[max(0, len(posteriors) - overlap_frames) :]
+        with self.decoder_factory.decoder() as decoder:
+            kws_result = decoder.search(np.exp(posteriors))
+        kws_result = json.loads(filter_kws_result(kws_result))
+        if kws_result:
+            self.logger.info(f"@StreamingKWS {kws_result = }")
+            with self._lock:
+                self.kws_result.update(kws_result)
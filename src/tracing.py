@@ -0,0 +1,148 @@
+# Stage timings of calls: per-call tracers and process wide latency histograms
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class StageHistograms:
+    """Cumulative duration histograms per stage, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, duration):
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                stage,
+                {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0},
+            )
+            histogram["buckets"][bisect_left(self.buckets, duration)] += 1
+            histogram["sum"] += duration
+            histogram["count"] += 1
+
+    def render(self):
+        lines = [
+            "# HELP amd_stage_duration_seconds Duration of the stages of AMD calls.",
+            "# TYPE amd_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(
+                    [*map(str, self.buckets), "+Inf"], histogram["buckets"]
+                ):
+                    cumulative += count
+                    lines.append(
+                        f'amd_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'amd_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}'
+                )
+                lines.append(
+                    f'amd_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically replace `path` with the rendered histograms."""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.render())
+        tmp_path.replace(path)
+
+
+stage_histograms = StageHistograms()
+
+
+class StageTracer:
+    def __init__(self, histograms=stage_histograms):
+        """Record how long the stages of one call take.
+
+        Every duration is also observed in `histograms`; pass None in worker
+        processes, whose timings are merged into the call tracer instead.
+
+        Args:
+            histograms (StageHistograms | None): process wide histograms
+        """
+        self.histograms = histograms
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def traced(self, stage, function):
+        """Wrap `function` so that each run is recorded as `stage` (e.g. for executors)."""
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def record(self, stage, duration):
+        with self._lock:
+            timing = self.stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += duration
+            timing["max"] = max(timing["max"], duration)
+        if self.histograms is not None:
+            self.histograms.observe(stage, duration)
+
+    def merge(self, totals):
+        """Record the {stage: duration} totals of another tracer (e.g. a segment worker)."""
+        for stage, duration in totals.items():
+            self.record(stage, duration)
+
+    def totals(self):
+        with self._lock:
+            return {stage: timing["total"] for stage, timing in self.stages.items()}
+
+    def summary(self):
+        """JSON friendly {stage: {count, total, max}} of the recorded stages."""
+        with self._lock:
+            return {stage: dict(timing) for stage, timing in self.stages.items()}
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = stage_histograms.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """Serve the stage histograms at http://0.0.0.0:<port>/metrics from a daemon thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever,
+        name="amd-metrics",
+        daemon=True,
+    ).start()
+    return server
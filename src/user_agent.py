@@ -1,78 +1,89 @@
 # The main code: launching an user agent
 
+import threading
 import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import pjsua2 as pj
 
-from config import UserAgent
+from config import Profiling, Tracing, UserAgent
 from custom_callbacks import Account
 from detection_algorithm import detect_answering_machine
+from persistence import PersistenceWriter
+from playback import get_playback_cache
+from shared_sad import get_shared_sad_model
+from tracing import StageTracer, stage_histograms, start_metrics_server
 from utils import (
-    add_call_log_to_database,
-    call_api,
+    endpoint_metrics,
+    get_keyword_cache,
     get_logger,
     get_number,
-    store_metadata,
-    store_wav,
+    get_segment_worker_pool,
 )
 
 
-def run_user_agent(
-    domain,
-    bot_username,
-    bot_password,
-    amd_dst,
-    non_amd_dst,
-):
-    """Run the user agent."""
-    # Log initial of the agent
-    logger = get_logger()
-    logger.info(f"Creating agent {bot_username}...")
+def register_pj_thread():
+    """Register the current (non-pjlib) thread before it touches pjsua objects."""
+    pj.Endpoint.instance().libRegisterThread(threading.current_thread().name)
 
-    # Create and initialize the library
-    ep = pj.Endpoint()
-    ep.libCreate()
 
-    # configure endpoint
-    ep_cfg = pj.EpConfig()
-    ep_cfg.logConfig.level = 0
-    ep_cfg.medConfig.noVad = True
-    ep.libInit(ep_cfg)
-    ep.audDevManager().setNullDev()
+class CallDispatcher:
+    """Run incoming calls on a bounded pool of AMD workers."""
 
-    # configure endpoint transport
-    sipTpConfig = pj.TransportConfig()
-    ep.transportCreate(pj.PJSIP_TRANSPORT_UDP, sipTpConfig)
+    def __init__(self, handler, max_concurrent_calls, max_queued_calls):
+        self.handler = handler
+        self.slots = threading.BoundedSemaphore(max_concurrent_calls + max_queued_calls)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_calls,
+            thread_name_prefix="amd-call",
+            initializer=register_pj_thread,
+        )
+        self.active_calls = 0
+        self.finished_calls = 0
+        self.closed = False
+        self._lock = threading.Lock()
 
-    # Start the library
-    ep.libStart()
+    def acquire_slot(self):
+        """Reserve a worker or queue slot for a new call, without blocking."""
+        if self.closed:
+            return False
+        return self.slots.acquire(blocking=False)
 
-    # create account config
-    acfg = pj.AccountConfig()
-    acfg.idUri = f"sip:{bot_username}@{domain}"
-    acfg.regConfig.registrarUri = f"sip:{domain}"
+    def dispatch(self, call):
+        self.executor.submit(self._run, call)
 
-    # create authentication config
-    cred = pj.AuthCredInfo("digest", "*", bot_username, 0, bot_password)
-    acfg.sipConfig.authCreds.append(cred)
+    def _run(self, call):
+        logger = get_logger()
+        with self._lock:
+            self.active_calls += 1
+        try:
+            self.handler(call)
+        except Exception:
+            logger.exception("exception at handle_call")
+        finally:
+            self.slots.release()
+            with self._lock:
+                self.active_calls -= 1
+                self.finished_calls += 1
 
-    # Create the account
-    acc = Account()
-    acc.create(acfg)
+    def shutdown(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
 
-    # wait for a call
-    last_registration_time = time.time()
-    while acc._call is None:
-        time.sleep(0.01)
-        # renewal condition
-        if time.time() - last_registration_time > UserAgent.renew_time:
-            last_registration_time = time.time()
-            logger.info("Renew Registration...")
-            acc.setRegistration(True)
-    call = acc._call
-    acc._call = None
+
+def handle_call(call, domain, amd_dst, non_amd_dst, persistence_writer):
+    """Answer a dispatched call, run AMD on it and transfer it."""
+    logger = get_logger()
     logger.info("Incoming call detected!")
+    tracer = StageTracer()
+    answer_time = time.time()
+
+    # answer the call now that a worker is available
+    call_op_param = pj.CallOpParam(True)
+    call_op_param.statusCode = pj.PJSIP_SC_OK
+    call.answer(call_op_param)
 
     # wait for call to be confirmed
     start_time_for_call_confirmation = time.time()
@@ -81,6 +92,7 @@ def run_user_agent(
         and time.time() - start_time_for_call_confirmation < UserAgent.max_inv_confirmed
     ):
         time.sleep(0.01)
+    tracer.record("call_confirmation", time.time() - start_time_for_call_confirmation)
     logger.info("Call confirmed!")
     logger.info(call.getInfo().remoteUri)
     logger.info(call.getInfo().remoteContact)
@@ -92,6 +104,7 @@ def run_user_agent(
         and time.time() - start_time_for_media_consent < UserAgent.max_media_consent
     ):
         time.sleep(0.1)
+    tracer.record("media_consent", time.time() - start_time_for_media_consent)
     logger.info("Media consented!")
     call_id = call.getInfo().callIdString
     logger.info(f"{call_id = }")
@@ -99,7 +112,8 @@ def run_user_agent(
     # run AM detection algorithm
     logger.info("Running AMD algorithm...")
     try:
-        metadata_dict = detect_answering_machine(call)
+        with tracer.span("detection"):
+            metadata_dict = detect_answering_machine(call, tracer)
     except Exception as E:
         logger.info("exception at navigate_dialogue " * 10)
         logger.info(E)
@@ -113,20 +127,20 @@ def run_user_agent(
 
     # make decision based on the result of the algorithm
     call_op_param = pj.CallOpParam(True)
-    match metadata_dict["result"]:
-        case "AMD":
-            call.xfer(f"sip:{amd_dst}@{domain}", call_op_param)
-        case "non-AMD":
-            call.xfer(f"sip:{non_amd_dst}@{domain}", call_op_param)
-        case _:
-            call.hangup(call_op_param)
-
-    # store call and metadata
+    with tracer.span("transfer"):
+        match metadata_dict["result"]:
+            case "AMD":
+                call.xfer(f"sip:{amd_dst}@{domain}", call_op_param)
+            case "non-AMD":
+                call.xfer(f"sip:{non_amd_dst}@{domain}", call_op_param)
+            case _:
+                call.hangup(call_op_param)
+    tracer.record("time_to_transfer", time.time() - answer_time)
+    metadata_dict["stages"] = tracer.summary()
+
+    # store call and metadata off the call's critical path
     logger.info("Storing call and metadata...")
-    store_wav(metadata_dict["call_id"] + ".wav")
-    store_metadata(metadata_dict)
-    add_call_log_to_database(metadata_dict)
-    call_api()
+    persistence_writer.submit(metadata_dict)
 
     # close the things out
     start_time_to_delete_call = time.time()
@@ -136,7 +150,129 @@ def run_user_agent(
     del call
     logger.info("Call finished!")
     logger.info(metadata_dict)
+    logger.info(f"endpoint metrics: {endpoint_metrics.snapshot()}")
+    return metadata_dict
+
+
+def run_user_agent(
+    domain,
+    bot_username,
+    bot_password,
+    amd_dst,
+    non_amd_dst,
+    max_concurrent_calls=UserAgent.max_concurrent_calls,
+    max_queued_calls=UserAgent.max_queued_calls,
+    max_calls=None,
+    profile_dir=None,
+):
+    """Run the user agent.
+
+    A single endpoint and registration is kept for the agent lifetime and each
+    incoming call is handled by its own worker. The agent stops after
+    `max_calls` calls are finished, or runs forever if it is None. With
+    `profile_dir`, resource usage of the agent and its workers is sampled there
+    (see profiler.ResourceProfiler).
+    """
+    # Log initial of the agent
+    logger = get_logger()
+    logger.info(f"Creating agent {bot_username}...")
+
+    # start the AM/ASR/KWS workers before pjsua starts its threads
+    get_segment_worker_pool()
+    # decode playbacks and load the SAD model once for all calls
+    get_playback_cache().preload()
+    get_shared_sad_model()
+    # fetch the keyword list before the first call needs it
+    get_keyword_cache().refresh()
+    # export stage latency histograms
+    if Tracing.metrics_port:
+        start_metrics_server(Tracing.metrics_port)
+
+    # Create and initialize the library
+    ep = pj.Endpoint()
+    ep.libCreate()
+
+    # configure endpoint
+    ep_cfg = pj.EpConfig()
+    ep_cfg.logConfig.level = 0
+    ep_cfg.uaConfig.maxCalls = max_concurrent_calls + max_queued_calls
+    ep_cfg.medConfig.noVad = True
+    ep.libInit(ep_cfg)
+    ep.audDevManager().setNullDev()
+
+    # configure endpoint transport
+    sipTpConfig = pj.TransportConfig()
+    ep.transportCreate(pj.PJSIP_TRANSPORT_UDP, sipTpConfig)
+
+    # Start the library
+    ep.libStart()
+
+    # create account config
+    acfg = pj.AccountConfig()
+    acfg.idUri = f"sip:{bot_username}@{domain}"
+    acfg.regConfig.registrarUri = f"sip:{domain}"
+
+    # create authentication config
+    cred = pj.AuthCredInfo("digest", "*", bot_username, 0, bot_password)
+    acfg.sipConfig.authCreds.append(cred)
+
+    # Create the call dispatcher and the account
+    persistence_writer = PersistenceWriter()
+    call_handler = partial(
+        handle_call,
+        domain=domain,
+        amd_dst=amd_dst,
+        non_amd_dst=non_amd_dst,
+        persistence_writer=persistence_writer,
+    )
+    profiler = None
+    if profile_dir:
+        # psutil is only needed for profiled runs
+        from profiler import ResourceProfiler
+
+        profiler = ResourceProfiler(
+            profile_dir,
+            "agent",
+            interval=Profiling.interval,
+            active_calls=lambda: dispatcher.active_calls,
+            cprofile=Profiling.cprofile,
+            py_spy=Profiling.py_spy,
+        )
+        call_handler = profiler.profiled(call_handler)
+    dispatcher = CallDispatcher(call_handler, max_concurrent_calls, max_queued_calls)
+    if profiler is not None:
+        profiler.start()
+    acc = Account(dispatcher)
+    acc.create(acfg)
+
+    # serve calls
+    last_registration_time = time.time()
+    last_metrics_time = time.time()
+    try:
+        while max_calls is None or dispatcher.finished_calls < max_calls:
+            time.sleep(0.1)
+            # renewal condition
+            if time.time() - last_registration_time > UserAgent.renew_time:
+                last_registration_time = time.time()
+                logger.info("Renew Registration...")
+                acc.setRegistration(True)
+            if (
+                Tracing.metrics_file
+                and time.time() - last_metrics_time > Tracing.metrics_interval
+            ):
+                last_metrics_time = time.time()
+                stage_histograms.write(Tracing.metrics_file)
+    finally:
+        logger.info("Waiting for active calls to finish...")
+        dispatcher.shutdown()
+        persistence_writer.close()
+        if Tracing.metrics_file:
+            stage_histograms.write(Tracing.metrics_file)
+        if profiler is not None:
+            profiler.stop()
+
     logger.info("deleting params...")
+    del acc
     # Destroy the library
     try:
         ep.libDestroy()
@@ -145,7 +281,6 @@ def run_user_agent(
     del ep
     logger.info("Agent finished!")
     logger.info("*" * 100)
-    return metadata_dict
 
 
 if __name__ == "__main__":
@@ -157,7 +292,19 @@ if __name__ == "__main__":
     parser.add_argument("--src-pass", type=str, default="pass8501")
     parser.add_argument("--amd-dst", type=str, default="7600")
     parser.add_argument("--non-amd-dst", type=str, default="7601")
+    parser.add_argument(
+        "--max-concurrent-calls", type=int, default=UserAgent.max_concurrent_calls
+    )
+    parser.add_argument(
+        "--max-queued-calls", type=int, default=UserAgent.max_queued_calls
+    )
     parser.add_argument("--always", action="store_true")
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default="",
+        help="sample CPU, memory, files and threads of the agent into this directory",
+    )
     args = parser.parse_args()
 
     while True:
@@ -168,6 +315,10 @@ if __name__ == "__main__":
                 bot_password=args.src_pass,
                 amd_dst=args.amd_dst,
                 non_amd_dst=args.non_amd_dst,
+                max_concurrent_calls=args.max_concurrent_calls,
+                max_queued_calls=args.max_queued_calls,
+                max_calls=None if args.always else 1,
+                profile_dir=args.profile_dir or None,
             )
         except Exception as E:
             logger.info("exception at run_user_agent")
@@ -4,26 +4,30 @@ import datetime
 import io
 import json
 import logging
+import multiprocessing
 import os
 import re
+import struct
+import threading
 import time
 from base64 import b64decode
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Process
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
 from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
-import pjsua2 as pj
 import requests
 import soundfile as sf
 import torch
-import torchaudio
 from kws_decoder import KWSDecoder
 from minio import Minio
 from redis import Redis
-from sqlalchemy import text
+from requests.adapters import HTTPAdapter
+from sqlalchemy import insert, text
 
 from config import (
     AIEndpoints,
@@ -38,14 +42,42 @@ from config import (
 )
 from database import db_session
 from models import AMDRecord
+from tracing import StageTracer
 
 _logger = None
+_history_cache = None
+_minio_client = None
+_minio_client_pid = None
+_no_history = object()
+_am_header = struct.Struct("<4sBIHff")
+_pcm_header = struct.Struct("<4sIH")
+_segment_worker = None
+_segment_worker_pool = None
+_segment_worker_pool_lock = threading.Lock()
+_keyword_cache = None
+_kws_decoder_factory = None
+_http_session = None
+_http_session_pid = None
 
 headers = {
     "Content-Type": "application/json",
     "Authorization": f"Bearer {KeywordAPIAccess.token}",
 }
 
+# recording format -> (soundfile format, subtype, file extension)
+RECORDING_FORMATS = {
+    "wav": ("WAV", "PCM_16", ".wav"),
+    "flac": ("FLAC", "PCM_16", ".flac"),
+    "opus": ("OGG", "OPUS", ".ogg"),
+}
+
+AM_POSTERIORS_CONTENT_TYPE = "application/x-am-posteriors"
+AM_POSTERIORS_MAGIC = b"AMP1"
+AM_POSTERIORS_DTYPES = ["float32", "float16", "uint8"]
+
+PCM_SEGMENT_CONTENT_TYPE = "application/x-amd-pcm"
+PCM_SEGMENT_MAGIC = b"PCM1"
+
 
 def get_logger() -> logging.Logger:
     """Get logger."""
@@ -59,6 +91,65 @@ def get_logger() -> logging.Logger:
     return _logger
 
 
+class LRUCache:
+    def __init__(
+        self,
+        max_size: int | None,
+        ttl: float | None = None,
+        max_bytes: int | None = None,
+        sizeof=None,
+    ):
+        """Thread safe least recently used cache.
+
+        Args:
+            max_size (int | None): maximum number of entries, None for no limit.
+            ttl (float | None, optional): entry lifetime in seconds. Defaults to None (never expire).
+            max_bytes (int | None, optional): maximum total size of the values, as measured by `sizeof`.
+                Defaults to None (no limit).
+            sizeof (Callable[[Any], int] | None, optional): size of a value in bytes, required with `max_bytes`.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expire_time = self._entries[key]
+            except KeyError:
+                return default
+            if expire_time is not None and time.time() > expire_time:
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expire_time = None if self.ttl is None else time.time() + self.ttl
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expire_time)
+            self._sizes[key] = size
+            self._bytes += size
+            # the newest entry is kept even if it alone exceeds max_bytes
+            while len(self._entries) > 1 and (
+                (self.max_size is not None and len(self._entries) > self.max_size)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
+
+
 def get_number(remote_uri):
     pattern = re.compile(r"<sip:[+]*(\d+)@")
     match_pattern = pattern.search(remote_uri)
@@ -68,11 +159,40 @@ def get_number(remote_uri):
         return "NEW-PATTERN:" + remote_uri
 
 
-def parse_new_frames(appended_bytes, info):
-    data = np.frombuffer(appended_bytes, dtype=np.int16)
-    data = data[:: info.channels]
-    data = data / (2 ** 15)
-    return data.astype(np.float32)
+def parse_new_frames(appended_bytes, channels=1, out=None):
+    """Convert 16 bit PCM bytes to float32 samples in [-1, 1).
+
+    Samples are scaled in float32 straight from the int16 view of the bytes. If
+    `out` is given they are written into it and a view of it is returned.
+    """
+    data = np.frombuffer(appended_bytes, dtype=np.int16)[::channels]
+    out = np.empty(len(data), dtype=np.float32) if out is None else out[: len(data)]
+    np.multiply(data, np.float32(2**-15), out=out, dtype=np.float32)
+    return out
+
+
+class FrameBuffer:
+    def __init__(self, capacity: int):
+        """Preallocated float32 ring that PCM frames are converted into in place.
+
+        `parse` returns views of the ring, valid until it wraps around onto them,
+        so callers must copy (e.g. concatenate) what they keep.
+
+        Args:
+            capacity (int): number of samples of the ring
+        """
+        self.buffer = np.empty(capacity, dtype=np.float32)
+        self.position = 0
+
+    def parse(self, appended_bytes, channels=1):
+        size = -(-len(appended_bytes) // (2 * channels))
+        if size > len(self.buffer):
+            return parse_new_frames(appended_bytes, channels)
+        if self.position + size > len(self.buffer):
+            self.position = 0
+        out = self.buffer[self.position : self.position + size]
+        self.position += size
+        return parse_new_frames(appended_bytes, channels, out)
 
 
 def convert_np_array_to_wav_file_bytes(np_array, fs):
@@ -82,42 +202,196 @@ def convert_np_array_to_wav_file_bytes(np_array, fs):
     return in_memory_file.read()
 
 
-def run_am_asr_kws(data):
-    logger = get_logger()
-    # run am model
-    am_result = call_api_non_blocking(
-        AIEndpoints.am_endpoint,
+def encode_pcm_segment(np_array, fs):
+    """Pack float samples as mono 16 bit PCM after a little endian header: magic, sampling rate and channels."""
+    scaled = np.multiply(np_array, np.float32(2**15), dtype=np.float32)
+    np.clip(scaled, -(2**15), 2**15 - 1, out=scaled)
+    return _pcm_header.pack(PCM_SEGMENT_MAGIC, fs, 1) + scaled.astype("<i2").tobytes()
+
+
+def decode_pcm_segment(data):
+    """Unpack a segment of `encode_pcm_segment` into (float32 samples, sampling rate)."""
+    _, fs, channels = _pcm_header.unpack_from(data)
+    samples = parse_new_frames(data[_pcm_header.size :], channels)
+    return samples, fs
+
+
+def encode_am_segment(np_array, fs):
+    """Encode an audio segment in the AM input format (`AIEndpoints.am_input_format`)."""
+    if AIEndpoints.am_input_format == "pcm":
+        return encode_pcm_segment(np_array, fs)
+    return convert_np_array_to_wav_file_bytes(np_array, fs)
+
+
+class SegmentWorker:
+    """Per-process state of an AM/ASR/KWS worker, kept alive across segments and calls."""
+
+    def __init__(self, asr_workers=1):
+        self.redis = Redis(
+            host=Algorithm.redis_host,
+            port=Algorithm.redis_port,
+            decode_responses=True,
+        )
+        self.asr_executor = ThreadPoolExecutor(max_workers=asr_workers)
+        self.decoder_factory = get_kws_decoder_factory()
+
+
+def init_segment_worker(asr_workers=1):
+    """Set up a worker process; `asr_workers` > 1 when segments of several calls run in it at once."""
+    global _segment_worker
+    _segment_worker = SegmentWorker(asr_workers)
+    # build the first decoders with the current keyword list
+    get_keyword_cache().refresh()
+    _segment_worker.decoder_factory.warm_up()
+
+
+def get_segment_worker_pool(wait_ready=True):
+    """Get the pool of AM/ASR/KWS worker processes, starting all of them on first use.
+
+    Workers come from a fork server rather than a fork of the agent, whose
+    pjsua, ORT and I/O threads may hold locks at fork time. With `wait_ready`,
+    a new pool is returned once all workers have started.
+    """
+    global _segment_worker_pool
+    with _segment_worker_pool_lock:
+        pool = _segment_worker_pool
+        created = pool is None
+        if created:
+            pool = _segment_worker_pool = ProcessPoolExecutor(
+                max_workers=Algorithm.am_asr_kws_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=init_segment_worker,
+            )
+    # start the workers outside the lock, submissions of other calls queue meanwhile
+    if created:
+        warm_up = [
+            pool.submit(time.sleep, 0.1) for _ in range(Algorithm.am_asr_kws_workers)
+        ]
+        if wait_ready:
+            wait(warm_up)
+    return pool
+
+
+def replace_broken_segment_worker_pool(broken_pool):
+    """Drop a broken worker pool (e.g. a worker was killed) so the next use starts a new one.
+
+    Several calls may notice the same broken pool, it is only replaced once.
+    """
+    global _segment_worker_pool
+    with _segment_worker_pool_lock:
+        if _segment_worker_pool is not broken_pool:
+            return
+        _segment_worker_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def encode_am_posteriors(am_out, dtype="float32"):
+    """Pack log probabilities of shape (T, num_labels) into the binary AM wire format.
+
+    The payload follows a little endian header: magic, dtype index, frames,
+    labels, scale and offset. uint8 payloads are linearly quantized log
+    probabilities, decoded as `value * scale + offset`.
+    """
+    scale, offset = 1.0, 0.0
+    if dtype == "uint8":
+        offset = float(am_out.min()) if am_out.size else 0.0
+        scale = (float(am_out.max()) - offset) / 255 if am_out.size else 1.0
+        scale = scale or 1.0
+        payload = np.round((am_out - offset) / scale).astype(np.uint8)
+    else:
+        payload = am_out.astype(dtype)
+    header = _am_header.pack(
+        AM_POSTERIORS_MAGIC,
+        AM_POSTERIORS_DTYPES.index(dtype),
+        am_out.shape[0],
+        am_out.shape[1],
+        scale,
+        offset,
+    )
+    return header + payload.tobytes()
+
+
+def decode_am_result(am_result):
+    """Decode the acoustic model response into log probabilities of shape (T, num_labels).
+
+    Both the binary wire format and the legacy base64 text are accepted.
+    """
+    if isinstance(am_result, bytes) and am_result.startswith(AM_POSTERIORS_MAGIC):
+        _, dtype_index, frames, labels, scale, offset = _am_header.unpack_from(am_result)
+        dtype = AM_POSTERIORS_DTYPES[dtype_index]
+        am_out = np.frombuffer(
+            am_result,
+            dtype=dtype,
+            count=frames * labels,
+            offset=_am_header.size,
+        ).reshape(frames, labels)
+        if dtype == "uint8":
+            am_out = am_out * scale + offset
+        return am_out.astype(np.float32)
+    np_buffer = b64decode(am_result)
+    am_out = np.frombuffer(np_buffer, dtype=np.float32)
+    return am_out.reshape(-1, KWSConfig.num_labels)
+
+
+def request_am(data, url=None):
+    """Run the acoustic model on WAV or raw PCM bytes, returning the raw (binary or base64) response."""
+    am_headers = {}
+    if data.startswith(PCM_SEGMENT_MAGIC):
+        am_headers["Content-Type"] = PCM_SEGMENT_CONTENT_TYPE
+    if AIEndpoints.am_binary:
+        am_headers["Accept"] = AM_POSTERIORS_CONTENT_TYPE
+    return call_api_non_blocking(
+        url or AIEndpoints.am_endpoint,
         data,
+        b"" if AIEndpoints.am_binary else "",
+        AIEndpoints.timeout,
+        headers=am_headers or None,
+    )
+
+
+def request_asr(am_result, url=None):
+    """Decode an AM output into a transcript, forwarding it in the format it was received."""
+    asr_headers = None
+    if isinstance(am_result, bytes) and am_result.startswith(AM_POSTERIORS_MAGIC):
+        asr_headers = {"Content-Type": AM_POSTERIORS_CONTENT_TYPE}
+    return call_api_non_blocking(
+        url or AIEndpoints.asr_decoder_endpoint,
+        am_result,
         "",
         AIEndpoints.timeout,
+        headers=asr_headers,
     )
+
+
+def run_am_asr_kws(data, tracer=None, am_endpoint=None, asr_endpoint=None):
+    """Run AM on a segment, then ASR and KWS on its output in parallel.
+
+    `am_endpoint` and `asr_endpoint` default to those of `AIEndpoints`; the
+    replay benchmark points them to per-recording stand-ins.
+    """
+    logger = get_logger()
+    tracer = tracer or StageTracer(histograms=None)
+    # run am model
+    with tracer.span("am_request"):
+        am_result = request_am(data, am_endpoint)
     if not am_result:
         logger.warning("check acoustic model...")
         return "", "", "{}"
 
-    def fetch_asr():
-        pj.Endpoint.instance().libRegisterThread("asr-worker")
-        return requests.get(
-            AIEndpoints.asr_decoder_endpoint,
-            data=am_result,
-            timeout=AIEndpoints.timeout,
-        )
-
-    # run asr in thread pool
-    executor = ThreadPoolExecutor(max_workers=1)
-    future_asr = executor.submit(fetch_asr)
+    # run asr in the worker thread pool
+    future_asr = _segment_worker.asr_executor.submit(
+        tracer.traced("asr_decode", request_asr), am_result, asr_endpoint
+    )
     # run kws in parallel with thread pool
-    decoder = get_kws_decoder()
-    np_buffer = b64decode(am_result)
-    am_out = np.frombuffer(np_buffer, dtype=np.float32)
-    am_out = am_out.reshape(-1, KWSConfig.num_labels)
-    am_probs = np.exp(am_out)
-    kws_result = decoder.search(am_probs)
+    with tracer.span("kws_search"):
+        am_probs = np.exp(decode_am_result(am_result))
+        with _segment_worker.decoder_factory.decoder() as decoder:
+            kws_result = decoder.search(am_probs)
     logger.info(f"@run_am_asr_kws (unfiltered) {kws_result = }")
     kws_result = filter_kws_result(kws_result)
     # kws result is ready, fetch asr result too
-    asr_response = future_asr.result(timeout=AIEndpoints.timeout)
-    asr_result = asr_response.text if asr_response.status_code == 200 else ""
+    with tracer.span("asr_wait"):
+        asr_result = future_asr.result(timeout=AIEndpoints.timeout)
 
     logger.info(f"@run_am_asr_kws {asr_result = }")
     logger.info(f"@run_am_asr_kws {kws_result = }")
@@ -125,62 +399,107 @@ def run_am_asr_kws(data):
 
 
 def lookahead_am_asr_kws_pipeline(data, call_id, segment_number):
+    """Run AM, ASR and KWS on a segment in a worker process.
+
+    Returns (asr_result, kws_result, stage timings, endpoint metrics); the
+    timings are merged into the call tracer and the endpoint metrics, counted
+    since the previous segment of this worker, into `endpoint_metrics` by the
+    agent process, which owns the histograms and logs the metrics.
+    """
+    tracer = StageTracer(histograms=None)
     # run am and asr
-    am_result, asr_result, kws_result = run_am_asr_kws(data)
-    # generate key for result: [am|asr|kws] + call_id + segment_number + time
-    redis_key_postfix = f"{call_id}_{segment_number}_{time.time()}"
-    am_redis_key = "am_" + redis_key_postfix
-    asr_redis_key = "asr_" + redis_key_postfix
-    kws_redis_key = "kws_" + redis_key_postfix
-    # put result in redis
-    redis = Redis(
-        host=Algorithm.redis_host,
-        port=Algorithm.redis_port,
-        decode_responses=True,
-    )
-    redis.set(am_redis_key, am_result, ex=Algorithm.expiration_time_second)
-    redis.set(asr_redis_key, asr_result, ex=Algorithm.expiration_time_second)
-    redis.set(kws_redis_key, kws_result, ex=Algorithm.expiration_time_second)
+    am_result, asr_result, kws_result = run_am_asr_kws(data, tracer)
+    # keep an audit copy in a per-call redis hash: [am|asr|kws] + segment_number
+    if Algorithm.redis_audit:
+        with tracer.span("redis_audit"):
+            store_segment_audit(call_id, segment_number, am_result, asr_result, kws_result)
+    return asr_result, kws_result, tracer.totals(), endpoint_metrics.take()
 
 
-def spawn_background_am_asr_kws(data, call_id, segment_number):
+def store_segment_audit(call_id, segment_number, am_result, asr_result, kws_result):
     logger = get_logger()
-    logger.info("spawn am + asr background process...")
-    p = Process(
-        target=lookahead_am_asr_kws_pipeline,
-        args=(data, call_id, segment_number),
-    )
-    p.start()
-    return p
+    redis_key = f"amd_{call_id}"
+    try:
+        if am_result:
+            am_result = encode_am_posteriors(
+                decode_am_result(am_result), Algorithm.redis_am_dtype
+            )
+        pipeline = _segment_worker.redis.pipeline(transaction=False)
+        pipeline.hset(
+            redis_key,
+            mapping={
+                f"am_{segment_number}": am_result,
+                f"asr_{segment_number}": asr_result,
+                f"kws_{segment_number}": kws_result,
+            },
+        )
+        pipeline.expire(redis_key, Algorithm.expiration_time_second)
+        pipeline.execute()
+    except Exception:
+        logger.exception("Can not store segment results in redis.")
 
 
-def recover_keys_and_results(key_regex):
-    redis = Redis(
-        host=Algorithm.redis_host,
-        port=Algorithm.redis_port,
-        decode_responses=True,
-    )
-    keys = sorted(redis.keys(key_regex))
+def submit_am_asr_kws(data, call_id, segment_number):
+    logger = get_logger()
+    logger.info("submit am + asr segment to worker pool...")
+    pool = get_segment_worker_pool()
     try:
-        key = keys[-1]
-    except IndexError:
-        key = None
-    if key is None:
-        return [], []
-    else:
-        return keys, [redis.get(key) for key in keys]
+        future = pool.submit(lookahead_am_asr_kws_pipeline, data, call_id, segment_number)
+    except BrokenProcessPool:
+        logger.exception("AM/ASR/KWS worker pool is broken, recreating it.")
+        replace_broken_segment_worker_pool(pool)
+        # the segment queues while the new workers start, the call is not held up
+        future = get_segment_worker_pool(wait_ready=False).submit(
+            lookahead_am_asr_kws_pipeline,
+            data,
+            call_id,
+            segment_number,
+        )
+    # merge the worker endpoint metrics even if the call no longer waits for the segment
+    future.add_done_callback(_merge_segment_endpoint_metrics)
+    return future
 
 
-def recover_asr_kws_results(call_id):
-    asr_keys, asr_results = recover_keys_and_results(f"asr_{call_id}_*")
-    _, kws_results = recover_keys_and_results(f"kws_{call_id}_*")
-    if asr_keys:
-        return asr_results, kws_results
-    return [], []
+def _merge_segment_endpoint_metrics(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    endpoint_metrics.merge(future.result()[3])
+
+
+def get_segment_result(future):
+    """Get (asr_result, kws_result, stage timings, endpoint metrics) of a finished segment future, empty on failure."""
+    logger = get_logger()
+    try:
+        return future.result(timeout=0)
+    except Exception:
+        logger.exception("AM/ASR/KWS segment worker failed.")
+        return "", "{}", {}, {}
+
+
+@dataclass(frozen=True)
+class CallHistory:
+    """Latest call to a dialed number, detached from the database session."""
+
+    call_id: str
+    asr_result: str
+    call_date: datetime.date
+    call_time: datetime.time
+
+
+def get_history_cache():
+    global _history_cache
+    if _history_cache is None:
+        _history_cache = LRUCache(Database.history_cache_size, Database.history_cache_ttl)
+    return _history_cache
 
 
 def get_amd_record(dialed_number):
+    """Get the latest call to a dialed number, from the local cache or the database."""
     logger = get_logger()
+    history_cache = get_history_cache()
+    cached = history_cache.get(dialed_number, _no_history)
+    if cached is not _no_history:
+        return cached
     try:
         db_session.execute(text(f"SET LOCAL statement_timeout TO {Database.timeout}"))
         amd_record = (
@@ -190,60 +509,160 @@ def get_amd_record(dialed_number):
             .first()
         )
         if amd_record is None:
+            history_cache.put(dialed_number, None)
             return None
-        return amd_record
+        call_history = CallHistory(
+            amd_record.call_id,
+            amd_record.asr_result,
+            amd_record.call_date,
+            amd_record.call_time,
+        )
+        history_cache.put(dialed_number, call_history)
+        return call_history
     except:
         logger.exception("Can not fetch AMD record from database.")
         return None
+    finally:
+        # end the read transaction, lookups may run on pooled threads
+        db_session.remove()
 
 
-def store_wav(file_path):
-    logger = get_logger()
-    try:
-        client = Minio(
+def get_minio_client():
+    """Get the object storage client of the current process, shared by all threads."""
+    global _minio_client, _minio_client_pid
+    if _minio_client is None or _minio_client_pid != os.getpid():
+        _minio_client = Minio(
             ObjectStorage.minio_url,
             access_key=ObjectStorage.minio_access_key,
             secret_key=ObjectStorage.minio_secret_key,
             secure=False,
         )
+        _minio_client_pid = os.getpid()
+    return _minio_client
+
+
+def store_wav(file_path, object_name=None):
+    """Upload a recording and remove the local file, return whether it succeeded."""
+    logger = get_logger()
+    try:
+        client = get_minio_client()
         client.fput_object(
             ObjectStorage.minio_wav_bucket_name,
-            file_path,
+            object_name or file_path,
             file_path,
         )
         os.remove(file_path)
+        return True
     except:
         logger.exception("Can not store wav file in object storage.")
+        return False
+
+
+def recording_object_names(call_id):
+    """Candidate object names of a call recording, configured format first."""
+    extensions = [RECORDING_FORMATS[ObjectStorage.recording_format][2], ".wav"]
+    return [call_id + extension for extension in dict.fromkeys(extensions)]
+
+
+def get_speech_regions(sad_result, duration, margin):
+    """Merge SAD segments widened by `margin` seconds into (start, end) regions within the call."""
+    regions = []
+    for segment in sorted(sad_result, key=itemgetter("start")):
+        start = max(0.0, segment["start"] - margin)
+        end = min(duration, segment["end"] + margin)
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return regions
+
+
+def compress_recording(wav_path, sad_result=None):
+    """Re-encode a recording in the configured format, optionally keeping only speech.
+
+    Args:
+        wav_path (str): local PCM recording, replaced by the compressed one
+        sad_result (list, optional): SAD segments of the call; the recording is
+            only trimmed when they are known. Defaults to None.
+
+    Returns:
+        tuple: path of the recording to upload and the kept speech regions (None if not trimmed)
+    """
+    fmt = ObjectStorage.recording_format
+    trim = ObjectStorage.speech_only and sad_result is not None
+    if fmt == "wav" and not trim:
+        return wav_path, None
+    data, fs = sf.read(wav_path, dtype="int16")
+    regions = None
+    if trim:
+        regions = get_speech_regions(
+            sad_result, len(data) / fs, ObjectStorage.speech_margin
+        )
+        data = np.concatenate(
+            [data[:0]] + [data[int(start * fs) : int(end * fs)] for start, end in regions]
+        )
+    container, subtype, extension = RECORDING_FORMATS[fmt]
+    output_path = str(Path(wav_path).with_suffix(extension))
+    sf.write(output_path, data, fs, format=container, subtype=subtype)
+    if output_path != wav_path:
+        os.remove(wav_path)
+    return output_path, regions
 
 
 def retrieve_wav(obj_name):
     logger = get_logger()
     try:
-        client = Minio(
-            ObjectStorage.minio_url,
-            access_key=ObjectStorage.minio_access_key,
-            secret_key=ObjectStorage.minio_secret_key,
-            secure=False,
-        )
+        client = get_minio_client()
         response = client.get_object(ObjectStorage.minio_wav_bucket_name, obj_name)
-        in_memory_wav_file = io.BytesIO(response.read())
-        wav_array, fs = torchaudio.load(in_memory_wav_file)
+        in_memory_file = io.BytesIO(response.read())
+        # WAV, FLAC and OGG/Opus are told apart by their header
+        data, fs = sf.read(in_memory_file, dtype="float32", always_2d=True)
+        wav_array = torch.from_numpy(data.T.copy())
     except:
         logger.exception("Can not retrieve wav file in object storage.")
         wav_array = torch.Tensor()
     return wav_array
 
 
+def store_features(call_id, features):
+    logger = get_logger()
+    try:
+        client = get_minio_client()
+        in_memory_file = io.BytesIO()
+        np.save(in_memory_file, features.astype(np.float16))
+        features_len = in_memory_file.tell()
+        in_memory_file.seek(0)
+        client.put_object(
+            ObjectStorage.minio_features_bucket_name,
+            call_id + ".npy",
+            in_memory_file,
+            features_len,
+        )
+    except:
+        logger.exception("Can not store features in object storage.")
+
+
+def retrieve_features(call_id):
+    logger = get_logger()
+    try:
+        client = get_minio_client()
+        response = client.get_object(
+            ObjectStorage.minio_features_bucket_name,
+            call_id + ".npy",
+        )
+        features = np.load(io.BytesIO(response.read())).astype(np.float32)
+    except:
+        logger.info(f"No stored features for {call_id}.")
+        features = None
+    return features
+
+
 def store_metadata(metadata_dict):
+    """Upload the call metadata as JSON, return whether it succeeded."""
     file_path = metadata_dict["call_id"] + ".json"
     logger = get_logger()
     try:
-        client = Minio(
-            ObjectStorage.minio_url,
-            access_key=ObjectStorage.minio_access_key,
-            secret_key=ObjectStorage.minio_secret_key,
-            secure=False,
-        )
+        client = get_minio_client()
         json_data = json.dumps(metadata_dict)
         json_data_len = len(json_data)
         json_data = io.BytesIO(json_data.encode())
@@ -253,57 +672,163 @@ def store_metadata(metadata_dict):
             json_data,
             json_data_len,
         )
+        return True
     except:
         logger.exception("Can not store metadata in object storage.")
-        with open(file_path, "w") as f:
-            json.dump(metadata_dict, f, indent=4)
+        return False
 
 
-def add_call_log_to_database(metadata_dict):
+def add_call_logs_to_database(call_logs):
+    """Insert call logs in a single multi-row statement, return whether it succeeded.
+
+    Args:
+        call_logs (list): (metadata_dict, call_datetime) pairs
+    """
     logger = get_logger()
+    if not call_logs:
+        return True
+    rows = [
+        {
+            "call_id": metadata_dict["call_id"],
+            "dialed_number": metadata_dict["dialed_number"],
+            "call_date": call_datetime.date(),
+            "call_time": call_datetime.time(),
+            "result": metadata_dict["result"],
+            "call_duration": metadata_dict["duration"],
+            "asr_result": metadata_dict["asr_result"],
+        }
+        for metadata_dict, call_datetime in call_logs
+    ]
     try:
-        now_datetime = datetime.datetime.now()
-        now_time = datetime.time(
-            now_datetime.hour,
-            now_datetime.minute,
-            now_datetime.second,
-            now_datetime.microsecond,
-        )
-        now_date = datetime.date(
-            now_datetime.year,
-            now_datetime.month,
-            now_datetime.day,
-        )
-        amd_record = AMDRecord(
-            metadata_dict["call_id"],
-            metadata_dict["dialed_number"],
-            now_date,
-            now_time,
-            metadata_dict["result"],
-            metadata_dict["duration"],
-            metadata_dict["asr_result"],
-        )
-        db_session.add(amd_record)
+        db_session.execute(insert(AMDRecord).values(rows))
         db_session.commit()
     except Exception as e:
         logger.warning(f"{e = }")
         logger.info("Cannot save metadata in database!")
+        db_session.rollback()
+        return False
+    finally:
+        db_session.remove()
+    for row in rows:
+        get_history_cache().put(
+            row["dialed_number"],
+            CallHistory(
+                row["call_id"],
+                row["asr_result"],
+                row["call_date"],
+                row["call_time"],
+            ),
+        )
+    return True
+
+
+def add_call_log_to_database(metadata_dict):
+    return add_call_logs_to_database([(metadata_dict, datetime.datetime.now())])
+
+
+class EndpointMetrics:
+    """Per-endpoint request counters and latencies of the current process.
+
+    The agent process also merges the counters of its segment workers.
+    """
+
+    def __init__(self):
+        self._metrics = defaultdict(
+            lambda: {"requests": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0}
+        )
+        self._lock = threading.Lock()
+
+    def record(self, url, latency, error):
+        with self._lock:
+            metrics = self._metrics[url]
+            metrics["requests"] += 1
+            metrics["errors"] += int(error)
+            metrics["total_latency"] += latency
+            metrics["max_latency"] = max(metrics["max_latency"], latency)
+
+    def take(self):
+        """Return the counters recorded since the previous call and reset them."""
+        with self._lock:
+            metrics = {url: dict(counters) for url, counters in self._metrics.items()}
+            self._metrics.clear()
+        return metrics
+
+    def merge(self, metrics):
+        """Add counters of another process, as returned by `take`."""
+        with self._lock:
+            for url, counters in metrics.items():
+                merged = self._metrics[url]
+                merged["requests"] += counters["requests"]
+                merged["errors"] += counters["errors"]
+                merged["total_latency"] += counters["total_latency"]
+                merged["max_latency"] = max(merged["max_latency"], counters["max_latency"])
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                url: dict(
+                    metrics,
+                    mean_latency=metrics["total_latency"] / metrics["requests"],
+                )
+                for url, metrics in self._metrics.items()
+            }
 
 
-def call_api_non_blocking(url, data, default, timeout):
+endpoint_metrics = EndpointMetrics()
+
+
+def get_http_session():
+    """Get the keep-alive HTTP session of the current process (sessions do not survive fork)."""
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=AIEndpoints.pool_connections,
+            pool_maxsize=AIEndpoints.pool_maxsize,
+            pool_block=False,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = session
+        _http_session_pid = os.getpid()
+    return _http_session
+
+
+def call_api_non_blocking(url, data, default, timeout, headers=None):
+    """Call an endpoint on the pooled session within `timeout` seconds overall.
+
+    Connection errors (e.g. a keep-alive connection closed by the server) are
+    retried up to `AIEndpoints.max_retries` times while the deadline allows.
+    """
     logger = get_logger()
-    try:
-        response = requests.get(url, data=data, timeout=timeout)
-        if response.status_code != 200:
-            logger.warning(f"non-200 status code for {url}")
-            response = None
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        logger.warning(f"Latency for {url} is high!")
-        response = None
+    session = get_http_session()
+    deadline = time.time() + timeout
+    response = None
+    for attempt in range(AIEndpoints.max_retries + 1):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        t0 = time.time()
+        try:
+            response = session.get(url, data=data, headers=headers, timeout=remaining)
+            endpoint_metrics.record(url, time.time() - t0, response.status_code != 200)
+            if response.status_code != 200:
+                logger.warning(f"non-200 status code for {url}")
+                response = None
+            break
+        except requests.exceptions.Timeout:
+            endpoint_metrics.record(url, time.time() - t0, True)
+            logger.warning(f"Latency for {url} is high!")
+            break
+        except requests.exceptions.ConnectionError:
+            endpoint_metrics.record(url, time.time() - t0, True)
+            logger.warning(f"Connection error for {url} (attempt {attempt + 1})")
     if response is None:
         return default
     if isinstance(default, str):
         return response.text
+    elif isinstance(default, bytes):
+        return response.content
     else:
         return response.json()
 
@@ -339,17 +864,124 @@ def get_sad_audio_buffer_duration(sad, fs):
     return sad.input_audio_buffer.shape[0] / fs
 
 
+class KeywordCache:
+    def __init__(self, url: str, refresh_interval: float, fallback: list[str]):
+        """In-process AM keyword list, refreshed by a background thread.
+
+        The keyword service is polled with If-None-Match, so an unchanged list
+        costs a 304 response. The version and the list are published together
+        as one immutable (version, keywords) tuple, read with `snapshot`; the
+        version is bumped whenever the list changes.
+
+        Args:
+            url (str): keyword service endpoint
+            refresh_interval (float): seconds between two refreshes
+            fallback (list[str]): keywords used until the service answers
+        """
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self._current = (0, tuple(fallback))
+        self.etag = None
+        self.pinned = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> tuple[int, tuple[str, ...]]:
+        """Current (version, keywords), consistent with each other."""
+        self.ensure_refresher()
+        return self._current
+
+    def get(self) -> list[str]:
+        return list(self.snapshot()[1])
+
+    @property
+    def version(self) -> int:
+        return self._current[0]
+
+    def _publish(self, keywords) -> bool:
+        """Swap in a new keyword list, return whether it changed."""
+        keywords = tuple(keywords)
+        with self._lock:
+            version, current = self._current
+            if keywords == current:
+                return False
+            self._current = (version + 1, keywords)
+        return True
+
+    def pin(self, keywords: list[str]) -> None:
+        """Use `keywords` from now on and never contact the keyword service (offline runs)."""
+        self.pinned = True
+        self._publish(keywords)
+
+    def ensure_refresher(self) -> None:
+        """Start the refresher thread, once per process (threads do not survive fork).
+
+        The first fetch runs on the refresher thread, callers keep the current
+        list meanwhile; `refresh` can be called at startup to prewarm the cache.
+        """
+        with self._lock:
+            if self.pinned or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="keyword-refresher", daemon=True).start()
+
+    def refresh(self) -> None:
+        """Fetch the keyword list, keeping the current one when the service fails."""
+        logger = get_logger()
+        if self.pinned:
+            return
+        request_headers = dict(headers)
+        if self.etag is not None:
+            request_headers["If-None-Match"] = self.etag
+        try:
+            response = requests.get(
+                self.url,
+                headers=request_headers,
+                timeout=KWSConfig.am_keywords_timeout,
+                verify=False,
+            )
+            if response.status_code == 304:
+                return
+            if response.status_code != 200:
+                logger.warning(
+                    f"Keyword service answered {response.status_code}, keeping cached keywords."
+                )
+                return
+            keywords = response.json()
+            if not isinstance(keywords, list):
+                raise ValueError(f"keyword list expected, got {type(keywords).__name__}")
+        except (requests.RequestException, ValueError):
+            logger.exception("Can not fetch keywords, keeping cached keywords.")
+            return
+        self.etag = response.headers.get("ETag")
+        if self._publish(keywords):
+            logger.info(f"Keywords updated to version {self.version}.")
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                get_logger().exception("Keyword refresh failed.")
+            time.sleep(self.refresh_interval)
+
+
+def get_keyword_cache():
+    global _keyword_cache
+    if _keyword_cache is None:
+        _keyword_cache = KeywordCache(
+            KWSConfig.am_keywords_url,
+            KWSConfig.am_keywords_refresh_interval,
+            KWSConfig.am_keywords,
+        )
+    return _keyword_cache
+
+
 def get_am_keywords():
-    try:
-        am_keywords = requests.get(
-            KWSConfig.am_keywords_url, headers=headers, timeout=0.1, verify=False
-        ).json()
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        am_keywords = KWSConfig.am_keywords
-    return am_keywords
+    return get_keyword_cache().get()
 
 
-def get_kws_decoder():
+def get_kws_decoder(keywords=None):
     decoder = KWSDecoder(KWSConfig.alphabet, KWSConfig.blank_index)
     decoder.set_beam_width(KWSConfig.beam_width)
     decoder.set_beta(KWSConfig.beta)
@@ -357,19 +989,71 @@ def get_kws_decoder():
     decoder.set_min_clip(KWSConfig.clip_char_prob)
     decoder.set_min_keyword_score(KWSConfig.min_keyword_score)
     decoder.set_top_n(KWSConfig.top_n)
-    keywords = get_am_keywords()
+    if keywords is None:
+        keywords = get_am_keywords()
     decoder.add_words(keywords)
     return decoder
 
 
-def get_background_noise():
-    path = Path(Algorithm.background_noise_dir)
-    files = list(path.glob("*.wav"))
-    if files:
-        file_path = np.random.choice(files)
-        filename = file_path.name
-        return str(file_path), filename
-    return "", ""
+class KWSDecoderFactory:
+    def __init__(self, keyword_cache):
+        """Hand out ready KWS decoders, built once per keyword list version.
+
+        Idle decoders are pooled and reused. When the keyword cache version
+        changes, a decoder for the new list is built and swapped in; decoders of
+        older versions are dropped when they are returned.
+
+        Args:
+            keyword_cache (KeywordCache): source of the keyword list and its version
+        """
+        self.keyword_cache = keyword_cache
+        self.version = None
+        self.keywords = ()
+        self.idle_decoders = []
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """Build the decoder for the current keyword version ahead of the first segment."""
+        with self.decoder():
+            pass
+
+    def _swap_if_outdated(self):
+        # version and keywords come from one snapshot, a decoder is never labelled with another list
+        version, keywords = self.keyword_cache.snapshot()
+        if version == self.version:
+            return
+        decoder = get_kws_decoder(list(keywords))
+        with self._lock:
+            # a concurrent swap may already have installed a newer list
+            if self.version is not None and version <= self.version:
+                return
+            self.version = version
+            self.keywords = keywords
+            self.idle_decoders = [decoder]
+        get_logger().info(f"KWS decoder rebuilt for keywords version {version}.")
+
+    @contextmanager
+    def decoder(self):
+        self._swap_if_outdated()
+        with self._lock:
+            version = self.version
+            keywords = self.keywords
+            decoder = self.idle_decoders.pop() if self.idle_decoders else None
+        if decoder is None:
+            decoder = get_kws_decoder(list(keywords))
+        try:
+            yield decoder
+        finally:
+            with self._lock:
+                if version == self.version:
+                    self.idle_decoders.append(decoder)
+
+
+def get_kws_decoder_factory():
+    global _kws_decoder_factory
+    if _kws_decoder_factory is None:
+        _kws_decoder_factory = KWSDecoderFactory(get_keyword_cache())
+    return _kws_decoder_factory
 
 
 def detect_gender(sad, sad_results, fs):
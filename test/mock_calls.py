@@ -1,38 +1,111 @@
-import multiprocessing
+import json
 import random
+import statistics
+import sys
+import threading
 import time
 from argparse import ArgumentParser
+from collections import Counter
 from pathlib import Path
 
 import pjsua2 as pj
 import soundfile as sf
 
+# the resource profiler is shared with the agent
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
 MAX_RING_TIME = 15
 
 
 class Call(pj.Call):
-    def __init__(self, acc):
+    def __init__(self, acc, record, decline_transfer=False):
+        """Outgoing test call; pjsua callbacks only record timestamps for the main loop.
+
+        Args:
+            acc (pj.Account): calling account
+            record (dict): per-call results, updated in place
+            decline_transfer (bool): reject the transfer of the agent instead of following it
+        """
         pj.Call.__init__(self, acc)
-        self.state_changed = False
+        self.record = record
+        self.decline_transfer = decline_transfer
+        self.lock = threading.Lock()
+        self.media_ready = False
+        self.disconnected = False
+        self.player = None
+        self.aud_med = None
+        self.hangup_time = None
+        self.hangup_sent = False
 
     def onCallState(self, prm):
-        self.state_changed = True
+        info = self.getInfo()
+        with self.lock:
+            if info.state == pj.PJSIP_INV_STATE_CONFIRMED and not self.record["setup_time"]:
+                self.record["setup_time"] = time.time() - self.record["start_time"]
+            elif info.state == pj.PJSIP_INV_STATE_DISCONNECTED:
+                self.record["duration"] = time.time() - self.record["start_time"]
+                self.record["last_status_code"] = info.lastStatusCode
+                self.disconnected = True
 
     def onCallMediaState(self, prm):
-        print("media state changed")
+        with self.lock:
+            self.media_ready = True
+
+    def onCallTransferRequest(self, prm):
+        # the agent transfers (REFER) the call to the AMD or the non-AMD destination
+        with self.lock:
+            self.record["transfer_target"] = prm.dstUri
+            self.record["transfer_time"] = time.time() - self.record["start_time"]
+        if self.decline_transfer:
+            prm.statusCode = pj.PJSIP_SC_DECLINE
+
+
+class ArrivalProcess:
+    def __init__(self, kind, rate, ramp_duration):
+        """Call arrivals: "poisson" at `rate` calls/s, "ramp" from 0 to `rate` over
+        `ramp_duration` seconds then Poisson, or "uniform" every 1 / `rate` seconds."""
+        self.kind = kind
+        self.rate = rate
+        self.ramp_duration = ramp_duration
+
+    def next_interval(self, elapsed):
+        if self.kind == "uniform":
+            return 1 / self.rate
+        rate = self.rate
+        if self.kind == "ramp" and elapsed < self.ramp_duration:
+            rate = max(self.rate * elapsed / self.ramp_duration, self.rate / 100)
+        return random.expovariate(rate)
+
+
+def parse_playback_mix(playback_folder, playback_mix):
+    """Playback files and weights: "file=weight,..." or all wavs of a folder, equally weighted."""
+    if playback_mix:
+        items = [item.rsplit("=", 1) for item in playback_mix.split(",")]
+        return [path for path, _ in items], [float(weight) for _, weight in items]
+    files = sorted(str(path) for path in Path(playback_folder).glob("*.wav"))
+    return files, [1.0] * len(files)
+
+
+def sample_holding_time(mean, distribution):
+    if distribution == "exponential":
+        return random.expovariate(1 / mean) if mean > 0 else 0.0
+    return mean
 
-    def getInfo(self):
-        self.state_changed = False
-        return super().getInfo()
 
+def percentiles(values):
+    if len(values) < 2:
+        return {"p50": values[0]} if values else {}
+    quantiles = statistics.quantiles(values, n=100)
+    return {"p50": quantiles[49], "p90": quantiles[89], "p99": quantiles[98]}
 
-def call_amd_agent(
-    domain,
-    src_username,
-    src_password,
-    dst_username,
-    playback_filename,
-):
+
+def run_load(args):
+    """Drive many concurrent calls from a single endpoint.
+
+    All pjsua calls are made from the main thread; callbacks only record state.
+    Each call plays a playback from the mix once media is up, stays on the line
+    for its holding time and is then hung up, unless the agent ends it first.
+    """
     # Create and initialize the library
     ep = pj.Endpoint()
     ep.libCreate()
@@ -41,6 +114,8 @@ def call_amd_agent(
     ep_cfg = pj.EpConfig()
     ep_cfg.logConfig.level = 0
     ep_cfg.logConfig.consoleLevel = 0
+    ep_cfg.uaConfig.maxCalls = args.max_active_calls
+    ep_cfg.medConfig.noVad = True
     ep.libInit(ep_cfg)
     ep.audDevManager().setNullDev()
 
@@ -51,143 +126,184 @@ def call_amd_agent(
     # Start the library
     ep.libStart()
 
-    # create account config
-    acfg = pj.AccountConfig()
-    acfg.idUri = f"sip:{src_username}@{domain}"
-    acfg.regConfig.registrarUri = f"sip:{domain}"
-
-    # create authentication config
-    cred = pj.AuthCredInfo("digest", "*", src_username, 0, src_password)
-    acfg.sipConfig.authCreds.append(cred)
-
-    # Create the account
-    acc = pj.Account()
-    acc.create(acfg)
+    # create and register the calling accounts
+    accounts = []
+    for i in range(args.accounts):
+        src_username = str(args.src_user_start + i)
+        acfg = pj.AccountConfig()
+        acfg.idUri = f"sip:{src_username}@{args.domain}"
+        acfg.regConfig.registrarUri = f"sip:{args.domain}"
+        cred = pj.AuthCredInfo("digest", "*", src_username, 0, "pass" + src_username)
+        acfg.sipConfig.authCreds.append(cred)
+        acc = pj.Account()
+        acc.create(acfg)
+        accounts.append((src_username, acc))
     time.sleep(1)
 
-    ########
-    # call #
-    ########
+    playback_files, playback_weights = parse_playback_mix(
+        args.playback_folder, args.playback_mix
+    )
+    playback_durations = {
+        path: sf.info(path).frames / sf.info(path).samplerate for path in playback_files
+    }
+    arrivals = ArrivalProcess(args.arrival, args.rate, args.ramp_duration)
     call_op_param = pj.CallOpParam(True)
-    call = Call(acc)
-    call.makeCall(f"sip:{dst_username}@{domain}", call_op_param)
 
-    # wait until MAX_RING_TIME
-    call_established = False
+    records = []
+    active_calls = []
+    profiler = None
+    if args.profile_dir:
+        from profiler import ResourceProfiler
+
+        profiler = ResourceProfiler(
+            args.profile_dir,
+            "load_generator",
+            interval=args.profile_interval,
+            active_calls=lambda: len(active_calls),
+        )
+        profiler.start()
+    # ended calls are kept referenced until the endpoint is destroyed
+    ended_calls = []
     t0 = time.time()
-    infos = []
-    while time.time() - t0 < MAX_RING_TIME:
-        if call.state_changed:
-            call_info = call.getInfo()
-            infos.append(call_info)
-            if call_info.state == pj.PJSIP_INV_STATE_CONFIRMED:
-                call_established = True
-                break
-    call_id = call.getInfo().callIdString
-    # sleep time must be bigger than network delay
-    time.sleep(0.5)
-    if call_established:
-        # audio recorder
-        wav_writer = pj.AudioMediaRecorder()
-        wav_writer.createRecorder(f"/tmp/ztmp-{call_id}.wav")
-
-        # get audio media
-        aud_med = call.getAudioMedia(0)
-        aud_med.startTransmit(wav_writer)
-
-        # audio player
-        player = pj.AudioMediaPlayer()
-        player.createPlayer(playback_filename, pj.PJMEDIA_FILE_NO_LOOP)
-        player.startTransmit(aud_med)
-
-        # wait till the end of playback
-        x, fs = sf.read(playback_filename)
-        time.sleep(x.shape[0] / fs)
-        try:
-            player.stopTransmit(aud_med)
-        except:
-            pass
-        time.sleep(5)
-        try:
-            call.hangup(call_op_param)
-        except:
-            pass
-
-    print("Delete pjsua objects")
-    try:
-        player.stopTransmit(aud_med)
-    except:
-        pass
-    try:
-        wav_writer = None
-        player = None
-    except:
-        pass
-    try:
-        del call
-    except:
-        pass
-    try:
-        del call_op_param
-    except:
-        pass
-    try:
-        del player
-    except:
-        pass
+    next_arrival = t0
+    while len(records) < args.number_of_calls or active_calls:
+        now = time.time()
+        # place new calls
+        if (
+            len(records) < args.number_of_calls
+            and now >= next_arrival
+            and len(active_calls) < args.max_active_calls
+        ):
+            index = len(records)
+            src_username, acc = accounts[index % len(accounts)]
+            dst_username = str(args.dst_num_start + index % args.dst_count)
+            playback_file = random.choices(playback_files, playback_weights)[0]
+            record = {
+                "index": index,
+                "src": src_username,
+                "dst": dst_username,
+                "playback": playback_file,
+                "start_time": now,
+                "setup_time": None,
+                "transfer_target": None,
+                "transfer_time": None,
+                "duration": None,
+                "last_status_code": None,
+                "holding_time": sample_holding_time(
+                    args.holding_time, args.holding_distribution
+                ),
+            }
+            records.append(record)
+            call = Call(acc, record, args.decline_transfers)
+            try:
+                call.makeCall(f"sip:{dst_username}@{args.domain}", call_op_param)
+                active_calls.append(call)
+            except pj.Error as e:
+                record["error"] = e.info()
+            next_arrival += arrivals.next_interval(now - t0)
+
+        # start playbacks, hang up calls past their holding time, drop ended calls
+        for call in list(active_calls):
+            record = call.record
+            with call.lock:
+                media_ready, disconnected = call.media_ready, call.disconnected
+            if disconnected:
+                active_calls.remove(call)
+                ended_calls.append(call)
+                continue
+            if media_ready and call.player is None:
+                call.aud_med = call.getAudioMedia(0)
+                call.player = pj.AudioMediaPlayer()
+                call.player.createPlayer(record["playback"], pj.PJMEDIA_FILE_NO_LOOP)
+                call.player.startTransmit(call.aud_med)
+                call.hangup_time = (
+                    now + playback_durations[record["playback"]] + record["holding_time"]
+                )
+            timed_out = (
+                call.hangup_time is None and now - record["start_time"] > MAX_RING_TIME
+            )
+            holding_over = call.hangup_time is not None and now > call.hangup_time
+            if (timed_out or holding_over) and not call.hangup_sent:
+                call.hangup_sent = True
+                try:
+                    call.hangup(call_op_param)
+                except pj.Error:
+                    active_calls.remove(call)
+                    ended_calls.append(call)
+        time.sleep(0.01)
+
+    # let pjsua finish the last transactions
+    time.sleep(1)
+    if profiler is not None:
+        profiler.stop()
+    for call in ended_calls:
+        call.player = None
+    for _, acc in accounts:
+        acc.shutdown()
     try:
         ep.libDestroy()
-    except:
+    except pj.Error:
         pass
-
-
-def call_amd_agent_wrapper(args_dict):
-    """Wrapper function to call 'call_amd_agent' with unpacked arguments."""
-    call_amd_agent(
-        domain=args_dict["domain"],
-        src_username=args_dict["src_username"],
-        src_password=args_dict["src_password"],
-        dst_username=args_dict["dst_username"],
-        playback_filename=args_dict["playback_filename"],
-    )
+    return records, time.time() - t0
 
 
 if __name__ == "__main__":
-    # Usage Example: python mock_call.py --domain 127.0.0.1 --src-user-start 74001 --number-of-calls 1 --dst-num-start 85001 --playback-folder wavs
+    # Usage Example: python mock_calls.py --domain 127.0.0.1 --src-user-start 7401 --number-of-calls 200 --rate 5 --arrival poisson --dst-num-start 8501 --playback-folder wavs
     parser = ArgumentParser()
     parser.add_argument("--domain", type=str, default="192.168.1.124")
     parser.add_argument("--src-user-start", type=int, default=7401)
+    parser.add_argument("--accounts", type=int, default=1)
     parser.add_argument("--number-of-calls", type=int, default=1)
     parser.add_argument("--dst-num-start", type=int, default=8501)
+    parser.add_argument("--dst-count", type=int, default=1)
     parser.add_argument("--playback-folder", type=str, default="wavs")
+    parser.add_argument(
+        "--playback-mix",
+        type=str,
+        default="",
+        help='weighted playbacks, e.g. "wavs/am.wav=0.7,wavs/live.wav=0.3"',
+    )
+    parser.add_argument(
+        "--arrival", type=str, default="poisson", choices=["poisson", "ramp", "uniform"]
+    )
+    parser.add_argument("--rate", type=float, default=1.0, help="calls per second")
+    parser.add_argument("--ramp-duration", type=float, default=60.0)
+    parser.add_argument(
+        "--holding-time",
+        type=float,
+        default=5.0,
+        help="seconds on the line after the playback",
+    )
+    parser.add_argument(
+        "--holding-distribution",
+        type=str,
+        default="fixed",
+        choices=["fixed", "exponential"],
+    )
+    parser.add_argument("--max-active-calls", type=int, default=256)
+    parser.add_argument("--decline-transfers", action="store_true")
+    parser.add_argument("--output", type=str, default="", help="per-call results (JSON)")
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default="",
+        help="sample CPU, memory, files and threads of the generator into this directory",
+    )
+    parser.add_argument("--profile-interval", type=float, default=1.0)
     args = parser.parse_args()
-    playbacks_path = Path(args.playback_folder)
-    playbacks_files = list(playbacks_path.glob("*.wav"))
-
-    # processes
-    processes = []
-    for i in range(args.number_of_calls):
-        src_user = args.src_user_start + i
-        dst_num = args.dst_num_start + i
-        playback_file = str(random.choice(playbacks_files))
-        print(f"Calling {dst_num} from {src_user} with playback file {playback_file}")
-        args_dict = {
-            "domain": args.domain,
-            "src_username": str(src_user),
-            "src_password": "pass" + str(src_user),
-            "dst_username": str(dst_num),
-            "playback_filename": playback_file,
-        }
-        p = multiprocessing.Process(
-            target=call_amd_agent_wrapper,
-            args=(args_dict,),
-        )
-        processes.append(p)
-
-    # Start all processes
-    for p in processes:
-        p.start()
 
-    # Wait for all processes to finish
-    for p in processes:
-        p.join()
+    records, wall_time = run_load(args)
+    setup_times = [r["setup_time"] for r in records if r["setup_time"] is not None]
+    transfer_times = [r["transfer_time"] for r in records if r["transfer_time"] is not None]
+    summary = {
+        "calls": len(records),
+        "established": len(setup_times),
+        "wall_time": wall_time,
+        "setup_time": percentiles(setup_times),
+        "transfer_time": percentiles(transfer_times),
+        "transfer_targets": Counter(str(r["transfer_target"]) for r in records),
+    }
+    print(json.dumps(summary, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "calls": records}, f, indent=4)
@@ -1,89 +1,82 @@
 # coding: utf-8
-import re
+import json
 from argparse import ArgumentParser
+from collections import defaultdict
 
 import matplotlib.pyplot as plt
 import numpy as np
 
 # HOW TO USE:
-# 1. Run the CPU usage logging script to generate "cpu_log.txt": top -b -d 0.1 | grep "^%Cpu" >> cpu_log.txt
-# 2. Run this script with the log file as an argument: python plot_cpu_usage.py --log-file cpu_log.txt
+# 1. Run the agent and/or the load generator with a profile directory:
+#    python user_agent.py --always --profile-dir profile
+#    python mock_calls.py ... --profile-dir profile
+# 2. Run this script with a resource log: python plot_cpu_usage.py --log-file profile/agent_resources.jsonl
 
 # Parse command-line arguments
-parser = ArgumentParser(description="Plot CPU usage from a log file.")
+parser = ArgumentParser(description="Plot resource usage from a profiler log file.")
 parser.add_argument(
     "--log-file",
     type=str,
     required=True,
-    help="Path to the CPU log file.",
+    help="Path to the <name>_resources.jsonl file of profiler.ResourceProfiler.",
 )
 args = parser.parse_args()
 
-# Initialize dictionary to store all CPU fields
-cpu_data = {
-    "us": [],
-    "sy": [],
-    "ni": [],
-    "id": [],
-    "wa": [],
-    "hi": [],
-    "si": [],
-    "st": [],
-}
-
-# Read the file
+# Read the samples
 with open(args.log_file, "r") as f:
-    for line in f:
-        if line.startswith("%Cpu"):
-            # Use regex to extract fields
-            matches = re.findall(r"([\d.]+) (\w+)", line)
-            for value, key in matches:
-                if key in cpu_data:
-                    cpu_data[key].append(float(value))
+    samples = [json.loads(line) for line in f if line.strip()]
+if not samples:
+    raise SystemExit("No samples in the log file.")
 
-# Convert lists to numpy arrays
-for key in cpu_data:
-    cpu_data[key] = np.array(cpu_data[key])
+t = np.array([sample["time"] for sample in samples])
+t = t - t[0]
+active_calls = np.array([sample["active_calls"] or 0 for sample in samples])
+main_cpu = np.array(
+    [sum(p["cpu_percent"] for p in sample["processes"] if p["main"]) for sample in samples]
+)
+children_cpu = np.array(
+    [sum(p["cpu_percent"] for p in sample["processes"] if not p["main"]) for sample in samples]
+)
+rss = np.array([sum(p["rss"] for p in sample["processes"]) for sample in samples]) / 2**20
+open_files = np.array([sum(p["open_files"] for p in sample["processes"]) for sample in samples])
+threads = np.array([sum(p["threads"] for p in sample["processes"]) for sample in samples])
+thread_groups = sorted({group for sample in samples for group in sample["threads"]})
+thread_cpu = {
+    group: np.array([sample["threads"].get(group, 0.0) for sample in samples])
+    for group in thread_groups
+}
 
 # Plot
-plt.figure(figsize=(10, 6))
-for key, values in cpu_data.items():
-    plt.plot(values, label=key)
-
-plt.title("CPU Usage Over Time")
-plt.xlabel("Time (samples)")
-plt.ylabel("Percentage (%)")
-plt.legend()
-plt.grid(True)
+fig, axes = plt.subplots(4, 1, figsize=(10, 12), sharex=True)
+axes[0].plot(t, main_cpu, label="main process")
+axes[0].plot(t, children_cpu, label="child processes")
+axes[0].set_ylabel("CPU (%)")
+axes[0].set_title("CPU usage per process")
+for group, values in thread_cpu.items():
+    axes[1].plot(t, values, label=group)
+axes[1].set_ylabel("CPU (%)")
+axes[1].set_title("CPU usage of the main process per thread role")
+axes[2].plot(t, rss, label="RSS (MiB)")
+axes[2].plot(t, open_files, label="open files")
+axes[2].plot(t, threads, label="threads")
+axes[2].set_title("Memory, files and threads (all processes)")
+axes[3].plot(t, active_calls, label="active calls")
+axes[3].set_xlabel("Time (s)")
+axes[3].set_title("Active calls")
+for ax in axes:
+    ax.legend()
+    ax.grid(True)
 plt.tight_layout()
 plt.show()
 
-# Statistics
-# Compute mean and std of `us`
-us = cpu_data["us"]
-us_mean = us.mean()
-us_std = us.std()
-threshold = us_mean + us_std
-
-# Find start and end indices
-start = next((i for i, val in enumerate(us) if val > threshold), None)
-if start is None:
-    start = 0
-end = next(
-    (i for i in reversed(range(len(us))) if us[i] < threshold and i > start), None
-)
-if end is None:
-    end = len(us) - 1
-
-# Check if valid window found
-if start is not None and end is not None and end > start:
-    us_avg = us[start : end + 1].mean()
-    sy_avg = cpu_data["sy"][start : end + 1].mean()
-    id_avg = cpu_data["id"][start : end + 1].mean()
+# Statistics: resource usage per number of active calls
+by_active_calls = defaultdict(list)
+for index, calls in enumerate(active_calls):
+    by_active_calls[int(calls)].append(index)
 
-    print(f"\n\nAverages between time steps {start} and {end} (us > mean + std):")
-    print(f"us (user):    {us_avg:.2f}%")
-    print(f"sy (system):  {sy_avg:.2f}%")
-    print(f"id (idle):    {id_avg:.2f}%")
-else:
-    print("No active interval found where 'us' exceeds mean + std.")
+print("\n\nactive calls | samples | main CPU (%) | children CPU (%) | RSS (MiB)")
+for calls, indices in sorted(by_active_calls.items()):
+    print(
+        f"{calls:12d} | {len(indices):7d} | {main_cpu[indices].mean():12.1f} "
+        f"| {children_cpu[indices].mean():16.1f} | {rss[indices].mean():9.1f}"
+    )